@@ -0,0 +1,159 @@
+# Streaming, page-aware text chunker shared by every ingest path.
+#
+# Pages are consumed one at a time from any iterable (e.g. iter_pdf_pages), so
+# a huge PDF is never joined into one string, and chunks are yielded as soon as
+# their page has been split. Chunks never span pages and end on sentence
+# boundaries (words, or bare character runs, for sentences that alone exceed
+# the size); each one carries its page number and character offsets within
+# that page. Overlap is made of whole trailing sentences (at most `overlap`
+# units), so neighbouring chunks repeat far less text than a blind slice does.
+#
+# Sizes are counted in characters by default, or with unit="tokens" in tokens
+# of the embedding model's tokenizer, which is what the model truncates at.
+import functools
+import re
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_OVERLAP = 200
+UNITS = ("chars", "tokens")
+
+# End of a sentence (punctuation, optional closing quotes/brackets, whitespace)
+# or a paragraph break.
+_BOUNDARY = re.compile(r"(?<=[.!?])[\"'”)\]]*\s+|\n\s*\n")
+_WORD = re.compile(r"\S+\s*")
+
+
+class Chunk(NamedTuple):
+    text: str
+    index: int  # position within the document
+    page: Optional[int]  # 1-based, None for unpaged text
+    page_chunk: int  # position within the page
+    start: int  # character offsets of `text` within its page
+    end: int
+
+    def metadata(self) -> dict:
+        return {"chunk": self.index, "page": self.page, "page_chunk": self.page_chunk, "start": self.start, "end": self.end}
+
+
+@functools.lru_cache(maxsize=4)
+def get_tokenizer(name: Optional[str] = None):
+    from transformers import AutoTokenizer
+
+    if name is None:
+        from app.storage.embedder import MODEL_NAME as name
+    return AutoTokenizer.from_pretrained(name)
+
+
+def _measure(unit: str) -> Callable[[List[str]], List[int]]:
+    if unit == "chars":
+        return lambda texts: [len(t) for t in texts]
+    if unit == "tokens":
+        tokenizer = get_tokenizer()
+        return lambda texts: [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]] if texts else []
+    raise ValueError(f"unit must be one of {UNITS}, got {unit!r}")
+
+
+def _spans(text: str, pattern: re.Pattern, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    end = len(text) if end is None else end
+    spans, pos = [], start
+    for m in pattern.finditer(text, start, end):
+        if m.end() > pos:
+            spans.append((pos, m.end()))
+            pos = m.end()
+    if pos < end:
+        spans.append((pos, end))
+    return spans
+
+
+# Cuts text[s:e] (`n` units long) into pieces of at most `size` units. Cut
+# points are estimated from the average characters per unit and pulled back
+# until the piece fits, so this works for both characters and tokens.
+def _pieces(text: str, s: int, e: int, n: int, size: int, measure) -> List[Tuple[int, int, int]]:
+    step = max(1, (e - s) * size // n)
+    pieces = []
+    while s < e:
+        cut = min(e, s + step)
+        m = measure([text[s:cut]])[0]
+        while m > size and cut - s > 1:
+            cut = s + max(1, min(cut - s - 1, (cut - s) * size // m))
+            m = measure([text[s:cut]])[0]
+        pieces.append((s, cut, m))
+        s = cut
+    return pieces
+
+
+# Sentences of `text` with their sizes; a sentence longer than `size` is cut
+# into runs of whole words instead, and a word longer than `size` (e.g. a
+# run of text without whitespace) into pieces.
+def _units(text: str, size: int, measure) -> List[Tuple[int, int, int]]:
+    spans = _spans(text, _BOUNDARY)
+    units = []
+    for (s, e), n in zip(spans, measure([text[s:e] for s, e in spans])):
+        if n <= size:
+            units.append((s, e, n))
+            continue
+        words = _spans(text, _WORD, s, e) if n else []
+        for (ws, we), wn in zip(words, measure([text[ws:we] for ws, we in words])):
+            units.extend(_pieces(text, ws, we, wn, size, measure) if wn > size else [(ws, we, wn)])
+    return units
+
+
+def _split(text: str, size: int, overlap: int, measure) -> Iterator[Tuple[int, int]]:
+    window: List[Tuple[int, int, int]] = []
+    total = 0
+    for unit in _units(text, size, measure):
+        if window and total + unit[2] > size:
+            yield window[0][0], window[-1][1]
+            # carry whole trailing sentences, never the entire window
+            keep, carried = len(window), 0
+            while keep > 1 and carried + window[keep - 1][2] <= min(overlap, size - unit[2]):
+                keep -= 1
+                carried += window[keep][2]
+            window, total = window[keep:], carried
+        window.append(unit)
+        total += unit[2]
+    if window:
+        yield window[0][0], window[-1][1]
+
+
+def chunk_pages(
+    pages: Iterable[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_OVERLAP,
+    unit: str = "chars",
+    paged: bool = True,
+) -> Iterator[Chunk]:
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    measure = _measure(unit)
+    index = 0
+    for page_num, text in enumerate(pages, start=1):
+        page_chunk = 0
+        for s, e in _split(text or "", chunk_size, max(0, overlap), measure):
+            piece = text[s:e]
+            stripped = piece.strip()
+            if not stripped:
+                continue
+            s += len(piece) - len(piece.lstrip())
+            yield Chunk(stripped, index, page_num if paged else None, page_chunk, s, s + len(stripped))
+            index += 1
+            page_chunk += 1
+
+
+def chunk_text(
+    text: str, chunk_size: int = DEFAULT_CHUNK_SIZE, overlap: int = DEFAULT_OVERLAP, unit: str = "chars"
+) -> Iterator[Chunk]:
+    return chunk_pages([text], chunk_size, overlap, unit, paged=False)
+
+
+def iter_pdf_pages(path: Path) -> Iterator[str]:
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(str(path))
+    for p in reader.pages:
+        try:
+            yield p.extract_text() or ""
+        except Exception:
+            yield ""
@@ -0,0 +1,80 @@
+# Process-wide sentence-transformers model for LocalFaissStore.
+#
+# Importing sentence_transformers pulls in torch and loading the weights takes
+# seconds, so nothing happens until the first encode (or an explicit preload).
+# Tools that only list or search existing collections by vector never pay it.
+#
+# Document chunks go through a persistent EmbeddingCache, so re-ingesting
+# unchanged text does not touch the model at all.
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from app.storage.embedding_cache import EmbeddingCache
+
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+CACHE_ENABLED = os.getenv("EMBEDDING_CACHE", "true") == "true"
+CACHE_PATH = Path(
+    os.getenv(
+        "EMBEDDING_CACHE_PATH",
+        str(Path(__file__).resolve().parent.parent / "faiss_data" / "cache" / "embeddings.sqlite"),
+    )
+)
+
+_model = None
+_model_lock = threading.Lock()
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+_preload_thread: Optional[threading.Thread] = None
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def embedding_dim() -> int:
+    return get_model().get_sentence_embedding_dimension()
+
+
+def encode(texts: List[str], **kwargs) -> np.ndarray:
+    return get_model().encode(texts, convert_to_numpy=True, **kwargs)
+
+
+def get_cache() -> Optional[EmbeddingCache]:
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(CACHE_PATH)
+    return _cache
+
+
+# Like encode(), but only texts missing from the embedding cache reach the model.
+def encode_documents(texts: List[str], **kwargs) -> np.ndarray:
+    cache = get_cache()
+    if cache is None:
+        return encode(texts, **kwargs)
+    return cache.encode(MODEL_NAME, texts, lambda missing: encode(missing, **kwargs))
+
+
+# Starts loading the model on a daemon thread so it is ready by the time the
+# first request needs it. The first encode simply waits on the same lock.
+def preload_in_background() -> threading.Thread:
+    global _preload_thread
+    with _model_lock:
+        if _preload_thread is None:
+            _preload_thread = threading.Thread(target=get_model, name="embedder-preload", daemon=True)
+            _preload_thread.start()
+    return _preload_thread
@@ -0,0 +1,61 @@
+# Content-addressed store of embeddings on disk.
+#
+# Keys are sha256(model name + text), so the same chunk embedded by the same
+# model is only ever encoded once, whatever collection or session it ends up
+# in. Vectors are stored exactly as the model returned them (float32, before
+# normalization).
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+_LOOKUP_SQL = "SELECT key, vector FROM embeddings WHERE key IN (SELECT value FROM json_each(?))"
+
+
+def cache_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self.lock:
+            rows = self.conn.execute(_LOOKUP_SQL, (json.dumps(keys),)).fetchall()
+        return {key: np.frombuffer(blob, dtype='float32') for key, blob in rows}
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, np.asarray(vector, dtype='float32').tobytes()) for key, vector in items.items()),
+            )
+            self.conn.commit()
+
+    # Embeds `texts` with `encode`, calling it only for texts (deduplicated)
+    # that are not cached yet.
+    def encode(self, model_name: str, texts: List[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        keys = [cache_key(model_name, text) for text in texts]
+        found = self.get_many(list(set(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = np.asarray(encode(list(missing.values())), dtype='float32')
+            new = dict(zip(missing.keys(), vectors))
+            self.put_many(new)
+            found.update(new)
+        return np.stack([found[key] for key in keys])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,118 +1,858 @@
 import os
 import json
+import re
 import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import faiss
 
+from app.storage import embedder
+from app.storage.index_factory import (
+    INDEX_TYPES,
+    STORAGE_TYPES,
+    effective_storage,
+    index_kind,
+    storage_kind,
+    training_size,
+)
+from app.storage.segments import SegmentedIndex, read_index_shared
+
 DATA_DIR = Path(__file__).resolve().parent.parent / "faiss_data"
-DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-MODEL = SentenceTransformer(os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"))
-EMBED_DIM = MODEL.get_sentence_embedding_dimension()
+MAX_DELTA_SEGMENTS = int(os.getenv("FAISS_MAX_DELTA_SEGMENTS", "8"))
+# "auto" collections switch from a flat scan to AUTO_INDEX_TYPE at this size
+ANN_THRESHOLD = int(os.getenv("FAISS_ANN_THRESHOLD", "100000"))
+AUTO_INDEX_TYPE = os.getenv("FAISS_AUTO_INDEX_TYPE", "ivf_flat")
+# With rescoring, lossy indexes return RESCORE_FACTOR * top_k candidates that
+# are re-ranked with exact scores from the float32 vectors in sqlite.
+RESCORE_FACTOR = int(os.getenv("FAISS_RESCORE_FACTOR", "4"))
+# Tombstoned vectors are purged by a background rebuild past this fraction.
+COMPACT_DEAD_FRACTION = float(os.getenv("FAISS_COMPACT_DEAD_FRACTION", "0.2"))
+# Open collections are evicted least-recently-used once their index files add
+# up to more than this.
+INDEX_CACHE_BYTES = int(os.getenv("FAISS_INDEX_CACHE_BYTES", str(2 * 1024**3)))
+
+# Metadata keys with an expression index, so filters on them are index lookups.
+INDEXED_METADATA = [key for key in os.getenv("FAISS_INDEXED_METADATA", "source,page").split(",") if key]
+# Filters matching at most this many docs are answered by an exact scan of
+# their stored vectors; larger ones are pushed into FAISS as an IDSelector,
+# unless they match more than FILTER_OVERFETCH_FRACTION of the collection, in
+# which case an over-fetched unfiltered search is cheaper.
+FILTER_EXACT_LIMIT = int(os.getenv("FAISS_FILTER_EXACT_LIMIT", "20000"))
+FILTER_OVERFETCH_FRACTION = float(os.getenv("FAISS_FILTER_OVERFETCH_FRACTION", "0.5"))
+
+# Reciprocal rank fusion constant; 60 is the value from the original RRF paper.
+RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+# One statement for any number of ids, so sqlite's statement cache can reuse it.
+_FETCH_DOCS_SQL = "SELECT id, text, metadata FROM docs WHERE id IN (SELECT value FROM json_each(?))"
+
+
+# EMBED_DIM used to be computed at import; keep the name, but only load the
+# model when somebody actually asks for it.
+def __getattr__(name: str):
+    if name == "EMBED_DIM":
+        return embedder.embedding_dim()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _meta_path(collection: str) -> Path:
     return DATA_DIR / f"{collection}.db"
 
 
-def _index_path(collection: str) -> Path:
-    return DATA_DIR / f"{collection}.index"
+# Sidecar file where scripts/ingest_local.py tracks which files it ingested.
+def manifest_path(collection: str) -> Path:
+    return DATA_DIR / f"{collection}.manifest.json"
+
+
+def _as_float32(embeddings: np.ndarray) -> np.ndarray:
+    # normalize_L2 works in place, so it must get the array that is used later
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+# Turns free text into an FTS5 query: every whitespace-separated term is
+# quoted (so "AB-1234" or "E_FAIL" match as written) and the terms are OR-ed
+# for BM25 to rank.
+def _fts_query(query: str) -> str:
+    terms = [term.replace('"', '""') for term in query.split() if re.search(r"\w", term)]
+    return " OR ".join(f'"{term}"' for term in terms)
+
+
+def _metadata_expr(key: str) -> str:
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key):
+        raise ValueError(f"Unsupported metadata filter key {key!r}")
+    # must match the indexed expression exactly for sqlite to use the index
+    return f"json_extract(metadata, '$.{key}')"
+
+
+# Equality filter on metadata -> SQL condition. A list/tuple/set value
+# matches any of its elements.
+def _filter_sql(where: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    clauses, params = [], []
+    for key, value in where.items():
+        if isinstance(value, (list, tuple, set)):
+            clauses.append(f"{_metadata_expr(key)} IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(value)))
+        else:
+            clauses.append(f"{_metadata_expr(key)} = ?")
+            params.append(value)
+    return " AND ".join(clauses) or "1", params
+
+
+def _rrf(rankings: List[List[int]], k: int = RRF_K) -> List[Tuple[float, int]]:
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(((score, id_) for id_, score in scores.items()), reverse=True)
+
+
+def _vectors_from_blobs(blobs: List[bytes]) -> np.ndarray:
+    return np.frombuffer(b"".join(blobs), dtype='float32').reshape(len(blobs), -1)
+
+
+# Read-only metadata mapping that decodes its JSON on first access.
+class LazyMetadata(Mapping):
+    __slots__ = ("_raw", "_data")
+
+    def __init__(self, raw: Optional[str]):
+        self._raw = raw
+        self._data: Optional[dict] = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            self._data = json.loads(self._raw) if self._raw else {}
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self) -> Iterator:
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __repr__(self) -> str:
+        return repr(self._load())
+
+
+# Long-lived sqlite connections for one collection. Writes go through a single
+# WAL-mode connection guarded by a lock; searches use a read-only connection per
+# thread so they never wait on writers.
+class _CollectionDB:
+    def __init__(self, collection: str):
+        self.path = _meta_path(collection)
+        self.write_lock = threading.Lock()
+        self.writer = sqlite3.connect(str(self.path), check_same_thread=False, cached_statements=256)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, metadata TEXT)"
+        )
+        self.writer.execute("CREATE TABLE IF NOT EXISTS collection_meta (key TEXT PRIMARY KEY, value TEXT)")
+        # ids deleted from docs whose vectors are still in the index files
+        self.writer.execute("CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY)")
+        columns = {row[1] for row in self.writer.execute("PRAGMA table_info(docs)")}
+        if "vector" not in columns:
+            # float32 copy of each embedding, used to train and rebuild indexes
+            self.writer.execute("ALTER TABLE docs ADD COLUMN vector BLOB")
+        self.has_fts = self._create_fts()
+        for key in INDEXED_METADATA:
+            self.writer.execute(f"CREATE INDEX IF NOT EXISTS docs_meta_{key} ON docs ({_metadata_expr(key)})")
+        self.writer.commit()
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+
+    # External-content FTS5 table over docs.text, kept in sync by triggers.
+    def _create_fts(self) -> bool:
+        exists = self.writer.execute("SELECT 1 FROM sqlite_master WHERE name = 'docs_fts'").fetchone()
+        try:
+            self.writer.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(text, content='docs', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS docs_fts_ai AFTER INSERT ON docs BEGIN
+                    INSERT INTO docs_fts(rowid, text) VALUES (new.id, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS docs_fts_ad AFTER DELETE ON docs BEGIN
+                    INSERT INTO docs_fts(docs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS docs_fts_au AFTER UPDATE OF text ON docs BEGIN
+                    INSERT INTO docs_fts(docs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    INSERT INTO docs_fts(rowid, text) VALUES (new.id, new.text);
+                END;
+            """)
+        except sqlite3.OperationalError:
+            # sqlite built without FTS5; hybrid search falls back to dense only
+            return False
+        if not exists:
+            self.writer.execute("INSERT INTO docs_fts(docs_fts) VALUES ('rebuild')")
+        return True
+
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False, cached_statements=256
+            )
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    # True if any connection (this process or another) has committed since
+    # the calling thread last asked.
+    def changed(self) -> bool:
+        version = self.reader().execute("PRAGMA data_version").fetchone()[0]
+        if getattr(self._local, "data_version", None) == version:
+            return False
+        self._local.data_version = version
+        return True
+
+    def fetch_docs(self, ids: List[int]) -> Dict[int, tuple]:
+        rows = self.reader().execute(_FETCH_DOCS_SQL, (json.dumps(ids),)).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    # Doc ids ordered by BM25 relevance (best first).
+    def lexical_search(self, query: str, limit: int, where: Optional[Dict[str, Any]] = None) -> List[int]:
+        match = _fts_query(query)
+        if not self.has_fts or not match:
+            return []
+        sql, params = "SELECT rowid FROM docs_fts WHERE docs_fts MATCH ?", [match]
+        if where:
+            condition, filter_params = _filter_sql(where)
+            sql += f" AND rowid IN (SELECT id FROM docs WHERE {condition})"
+            params += filter_params
+        rows = self.reader().execute(sql + " ORDER BY bm25(docs_fts) LIMIT ?", params + [limit]).fetchall()
+        return [row[0] for row in rows]
+
+    def filter_ids(self, where: Dict[str, Any]) -> np.ndarray:
+        condition, params = _filter_sql(where)
+        rows = self.reader().execute(f"SELECT id FROM docs WHERE {condition}", params).fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def vectors_for_ids(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        rows = self.reader().execute(
+            "SELECT id, vector FROM docs WHERE id IN (SELECT value FROM json_each(?)) AND vector IS NOT NULL",
+            (json.dumps(ids.tolist()),),
+        ).fetchall()
+        if not rows:
+            return np.empty(0, dtype='int64'), np.empty((0, 0), dtype='float32')
+        return np.array([row[0] for row in rows], dtype='int64'), _vectors_from_blobs([row[1] for row in rows])
+
+    # Runs on the writer connection inside the caller's transaction. Deletes the
+    # rows, tombstones their vectors and returns the ids actually deleted.
+    def delete_docs(self, ids: Optional[List[int]] = None, where: Optional[Dict[str, Any]] = None) -> List[int]:
+        if where is not None:
+            condition, params = _filter_sql(where)
+            rows = self.writer.execute(f"SELECT id FROM docs WHERE {condition}", params).fetchall()
+        else:
+            rows = self.writer.execute(
+                "SELECT id FROM docs WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(ids or [])),)
+            ).fetchall()
+        dead = [row[0] for row in rows]
+        if dead:
+            payload = json.dumps(dead)
+            self.writer.execute("DELETE FROM docs WHERE id IN (SELECT value FROM json_each(?))", (payload,))
+            self.writer.execute("INSERT OR IGNORE INTO tombstones (id) SELECT value FROM json_each(?)", (payload,))
+        return dead
+
+    def tombstones(self) -> np.ndarray:
+        rows = self.reader().execute("SELECT id FROM tombstones").fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    # Writer connection, caller's transaction.
+    def clear_tombstones(self, ids: List[int]):
+        self.writer.execute("DELETE FROM tombstones WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))
+
+    def max_id(self) -> int:
+        return self.reader().execute("SELECT COALESCE(MAX(id), 0) FROM docs").fetchone()[0]
+
+    def count_vectors(self, max_id: int) -> int:
+        return self.reader().execute(
+            "SELECT COUNT(*) FROM docs WHERE id <= ? AND vector IS NOT NULL", (max_id,)
+        ).fetchone()[0]
+
+    def sample_vectors(self, n: int, max_id: int) -> Optional[np.ndarray]:
+        if n <= 0:
+            return None
+        rows = self.reader().execute(
+            "SELECT vector FROM docs WHERE id <= ? AND vector IS NOT NULL ORDER BY random() LIMIT ?", (max_id, n)
+        ).fetchall()
+        return _vectors_from_blobs([row[0] for row in rows])
+
+    def iter_vectors(self, max_id: int, batch_size: int = 65536) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        cur = self.reader().execute(
+            "SELECT id, vector FROM docs WHERE id <= ? AND vector IS NOT NULL ORDER BY id", (max_id,)
+        )
+        while rows := cur.fetchmany(batch_size):
+            ids = np.array([row[0] for row in rows], dtype='int64')
+            yield ids, _vectors_from_blobs([row[1] for row in rows])
+
+    # Collections created before vectors were stored in sqlite only have them in
+    # their flat indexes; copy them over so the collection can be rebuilt.
+    def backfill_vectors(self, indexes: List[faiss.Index]):
+        if not self.reader().execute("SELECT 1 FROM docs WHERE vector IS NULL LIMIT 1").fetchone():
+            return
+        for index in indexes:
+            index = faiss.downcast_index(index)
+            if not isinstance(index, faiss.IndexIDMap) or index_kind(index) != "flat" or index.ntotal == 0:
+                continue
+            vectors = index.index.reconstruct_n(0, index.ntotal)
+            ids = faiss.vector_to_array(index.id_map)
+            with self.write_lock:
+                self.writer.executemany(
+                    "UPDATE docs SET vector = ? WHERE id = ? AND vector IS NULL",
+                    ((vector.tobytes(), int(id_)) for vector, id_ in zip(vectors, ids)),
+                )
+                self.writer.commit()
+
+    def meta(self, conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
+        rows = (conn or self.reader()).execute("SELECT key, value FROM collection_meta").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    # Runs on the writer connection; the caller commits.
+    def set_meta(self, **values: Any):
+        self.writer.executemany(
+            "INSERT OR REPLACE INTO collection_meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in values.items()],
+        )
+
+    def close(self):
+        with self.write_lock, self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+            self.writer.close()
+
+    # The store drops a db without closing it, since searches may still be
+    # using it; its connections are closed once the last of them finishes.
+    def __del__(self):
+        if hasattr(self, "_readers"):
+            self.close()
 
 
 class LocalFaissStore:
-    def __init__(self):
-        self._open_indexes: Dict[str, faiss.Index] = {}
+    def __init__(self, max_index_bytes: int = INDEX_CACHE_BYTES):
+        self.max_index_bytes = max_index_bytes
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._open_indexes: "OrderedDict[str, SegmentedIndex]" = OrderedDict()
+        self._dbs: Dict[str, _CollectionDB] = {}
+        self._dbs_lock = threading.RLock()
+
+    def _db(self, collection: str) -> _CollectionDB:
+        db = self._dbs.get(collection)
+        if db is None:
+            with self._dbs_lock:
+                db = self._dbs.get(collection)
+                if db is None:
+                    DATA_DIR.mkdir(parents=True, exist_ok=True)
+                    db = _CollectionDB(collection)
+                    self._dbs[collection] = db
+        return db
 
     def _ensure_db(self, collection: str):
-        dbp = _meta_path(collection)
-        create = not dbp.exists()
-        conn = sqlite3.connect(str(dbp))
-        if create:
-            conn.execute(
-                "CREATE TABLE docs (id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, metadata TEXT)"
-            )
-            conn.commit()
-        conn.close()
+        self._db(collection)
+
+    def close(self):
+        with self._dbs_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            for db in self._dbs.values():
+                db.close()
+            self._dbs.clear()
+            self._open_indexes.clear()
 
     def get_collections(self) -> List[str]:
         return [p.stem for p in DATA_DIR.glob("*.db")]
 
-    def create_collection(self, collection: str, *, dim: int = EMBED_DIM):
-        self._ensure_db(collection)
-        idx_p = _index_path(collection)
-        if not idx_p.exists():
-            base = faiss.IndexFlatIP(dim)
-            idm = faiss.IndexIDMap(base)
-            faiss.write_index(idm, str(idx_p))
-
-    def _load_index(self, collection: str) -> faiss.Index:
-        if collection in self._open_indexes:
-            return self._open_indexes[collection]
-        idx_p = _index_path(collection)
-        if not idx_p.exists():
-            base = faiss.IndexFlatIP(EMBED_DIM)
-            idm = faiss.IndexIDMap(base)
-            faiss.write_index(idm, str(idx_p))
-        idx = faiss.read_index(str(idx_p))
-        self._open_indexes[collection] = idx
+    # Seconds since the collection's database was last written.
+    def collection_age(self, collection: str) -> float:
+        paths = [_meta_path(collection), Path(f"{_meta_path(collection)}-wal")]
+        mtime = max(p.stat().st_mtime for p in paths if p.exists())
+        return time.time() - mtime
+
+    # `storage` picks how the base index encodes vectors (see index_factory);
+    # `rescore` defaults to on for the lossy sq8 and pq encodings.
+    def create_collection(
+        self,
+        collection: str,
+        *,
+        dim: Optional[int] = None,
+        index_type: str = "auto",
+        storage: str = "float32",
+        rescore: Optional[bool] = None,
+    ):
+        if index_type != "auto" and index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected 'auto' or one of {INDEX_TYPES}")
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_TYPES}")
+        db = self._db(collection)
+        if "dim" not in db.meta():
+            with db.write_lock:
+                db.set_meta(
+                    dim=dim or embedder.embedding_dim(),
+                    model=embedder.MODEL_NAME,
+                    index_type=index_type,
+                    storage=storage,
+                    rescore=storage in ("sq8", "pq") if rescore is None else rescore,
+                )
+                db.writer.commit()
+        self._load_index(collection)
+
+    def _load_index(self, collection: str) -> SegmentedIndex:
+        with self._dbs_lock:
+            idx = self._open_indexes.get(collection)
+            if idx is not None:
+                self._open_indexes.move_to_end(collection)
+                return idx
+            db = self._db(collection)
+            idx = SegmentedIndex(collection, DATA_DIR, db, self.collection_dim(collection))
+            self._open_indexes[collection] = idx
+            self._evict()
         return idx
 
-    def _save_index(self, collection: str):
-        if collection in self._open_indexes:
-            faiss.write_index(self._open_indexes[collection], str(_index_path(collection)))
+    # Drops least-recently-used indexes until the open ones fit in
+    # max_index_bytes, along with the sqlite dbs of every collection that no
+    # longer has an open index. The most recent one always stays; searches
+    # still holding an evicted index or db finish normally.
+    def _evict(self):
+        sizes = {name: idx.nbytes() for name, idx in self._open_indexes.items()}
+        total = sum(sizes.values())
+        while total > self.max_index_bytes and len(self._open_indexes) > 1:
+            name, _ = self._open_indexes.popitem(last=False)
+            total -= sizes[name]
+        for name in [name for name in self._dbs if name not in self._open_indexes]:
+            del self._dbs[name]
+
+    # Dimension of a collection's vectors, from its meta table. Collections
+    # written before the dim was recorded get it from their index file; only
+    # a brand-new collection needs the model.
+    def collection_dim(self, collection: str) -> int:
+        db = self._db(collection)
+        meta = db.meta()
+        if "dim" in meta:
+            return meta["dim"]
+        legacy_path = DATA_DIR / f"{collection}.index"
+        dim = read_index_shared(legacy_path).d if legacy_path.exists() else embedder.embedding_dim()
+        with db.write_lock:
+            db.set_meta(dim=dim)
+            db.writer.commit()
+        return dim
+
+    def index_bytes(self, collection: str) -> int:
+        return self._load_index(collection).nbytes()
+
+    def compact(self, collection: str):
+        self._load_index(collection).compact()
 
-    def add_texts(self, collection: str, texts: List[str], metadatas: Optional[List[dict]] = None):
-        self._ensure_db(collection)
-        conn = sqlite3.connect(str(_meta_path(collection)))
-        cur = conn.cursor()
+    # `meta_updates` are recorded in the same transaction that publishes the
+    # new base, so the meta never describes an index that failed to build.
+    def rebuild_index(
+        self,
+        collection: str,
+        index_type: Optional[str] = None,
+        storage: Optional[str] = None,
+        meta_updates: Optional[Dict[str, Any]] = None,
+    ) -> Optional[str]:
+        meta = {**self._db(collection).meta(), **(meta_updates or {})}
+        index_type = index_type or meta.get("index_type", "auto")
+        if index_type == "auto":
+            index_type = AUTO_INDEX_TYPE if self._load_index(collection).ntotal >= ANN_THRESHOLD else "flat"
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        storage = storage or meta.get("storage", "float32")
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_TYPES}")
+        return self._load_index(collection).rebuild(index_type, storage=storage, meta=meta_updates)
+
+    # Re-encodes an existing collection with a different storage (and
+    # optionally index type), recording the choice for future rebuilds.
+    def migrate_storage(
+        self,
+        collection: str,
+        storage: str,
+        *,
+        index_type: Optional[str] = None,
+        rescore: Optional[bool] = None,
+    ):
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_TYPES}")
+        if index_type is not None and index_type != "auto" and index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected 'auto' or one of {INDEX_TYPES}")
+        updates: Dict[str, Any] = {
+            "storage": storage,
+            "rescore": storage in ("sq8", "pq") if rescore is None else rescore,
+        }
+        if index_type is not None:
+            updates["index_type"] = index_type
+        if self.rebuild_index(collection, meta_updates=updates) is None:
+            raise RuntimeError(f"{collection} was rebuilt concurrently; its storage is unchanged, retry the migration")
+
+    def _maybe_upgrade_index(self, collection: str, idx: SegmentedIndex):
+        meta = self._db(collection).meta()
+        index_type = meta.get("index_type", "auto")
+        storage = meta.get("storage", "float32")
+        kind = index_kind(idx.base)
+        if index_type == "auto":
+            target = AUTO_INDEX_TYPE if idx.ntotal >= ANN_THRESHOLD else "flat"
+        else:
+            target = index_type
+        if target == "flat" and kind != "flat":
+            return
+        if kind == target and storage_kind(idx.base) == effective_storage(target, storage):
+            return
+        # an explicit ANN type waits until there is enough data for a sensible nlist
+        n = ANN_THRESHOLD if kind == "flat" and target != "flat" else idx.ntotal
+        if idx.ntotal >= max(training_size(target, n, storage), 1):
+            idx.rebuild_in_background(target, storage)
+
+    # `embeddings` may be passed when the caller has already encoded `texts`
+    # (e.g. in batches larger than one call), skipping the embedder.
+    def add_texts(
+        self,
+        collection: str,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        embeddings: Optional[np.ndarray] = None,
+    ) -> List[int]:
+        return self._write(collection, texts, metadatas, embeddings=embeddings)
+
+    def delete_by_ids(self, collection: str, ids: List[int]) -> int:
+        if not _meta_path(collection).exists():
+            return 0
+        return len(self._write(collection, [], delete_ids=ids, return_deleted=True))
+
+    def delete_by_metadata(self, collection: str, where: Dict[str, Any]) -> int:
+        if not where:
+            raise ValueError("delete_by_metadata needs a non-empty filter")
+        if not _meta_path(collection).exists():
+            return 0
+        return len(self._write(collection, [], delete_where=where, return_deleted=True))
+
+    # Replaces every doc matching `where` (e.g. {"source": "a.pdf"}) with
+    # `texts` in a single transaction, so searches see either the old chunks
+    # or the new ones. Returns the new ids.
+    def upsert(
+        self,
+        collection: str,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        where: Dict[str, Any],
+        embeddings: Optional[np.ndarray] = None,
+    ) -> List[int]:
+        if not where:
+            raise ValueError("upsert needs a non-empty filter to replace")
+        return self._write(collection, texts, metadatas, delete_where=where, embeddings=embeddings)
+
+    # Single write path: deletes (as tombstones) and inserts are committed
+    # together with the new delta segment and a generation bump.
+    def _write(
+        self,
+        collection: str,
+        texts: List[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        delete_ids: Optional[List[int]] = None,
+        delete_where: Optional[Dict[str, Any]] = None,
+        embeddings: Optional[np.ndarray] = None,
+        return_deleted: bool = False,
+    ) -> List[int]:
+        deleting = delete_ids is not None or delete_where is not None
+        if not texts and not deleting:
+            return []
+        db = self._db(collection)
         metas = metadatas or [{} for _ in texts]
 
-        embeddings = MODEL.encode(texts, convert_to_numpy=True, show_progress_bar=False)
-        faiss.normalize_L2(embeddings.astype('float32'))
+        if texts and embeddings is None:
+            embeddings = embedder.encode_documents(texts, show_progress_bar=False)
+        if texts:
+            embeddings = _as_float32(embeddings)
 
         idx = self._load_index(collection)
-        if not isinstance(idx, faiss.IndexIDMap):
-            base = idx
-            idx = faiss.IndexIDMap(base)
-            self._open_indexes[collection] = idx
+        with db.write_lock:
+            db.writer.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = db.delete_docs(ids=delete_ids, where=delete_where) if deleting else []
+                cur = db.writer.cursor()
+                inserted_ids = []
+                for txt, meta, vector in zip(texts, metas, embeddings if texts else []):
+                    cur.execute(
+                        "INSERT INTO docs (text, metadata, vector) VALUES (?, ?, ?)",
+                        (txt, json.dumps(meta), vector.tobytes()),
+                    )
+                    inserted_ids.append(cur.lastrowid)
+                segment = None
+                if inserted_ids:
+                    name, segment, generation = idx.write_segment(embeddings, np.array(inserted_ids, dtype='int64'))
+                elif deleted:
+                    db.set_meta(generation=db.meta(db.writer).get("generation", 0) + 1)
+                db.writer.commit()
+            except Exception:
+                db.writer.rollback()
+                raise
+            if deleted:
+                idx.reload()
+            elif segment is not None:
+                idx.attach(name, segment, generation)
 
-        inserted_ids = []
-        for txt, meta in zip(texts, metas):
-            cur.execute("INSERT INTO docs (text, metadata) VALUES (?, ?)", (txt, json.dumps(meta)))
-            inserted_ids.append(cur.lastrowid)
-        conn.commit()
+        if len(idx.deltas) >= MAX_DELTA_SEGMENTS:
+            idx.compact_in_background()
+        if idx.dead_fraction > COMPACT_DEAD_FRACTION:
+            self._purge_in_background(collection, idx)
+        else:
+            self._maybe_upgrade_index(collection, idx)
+        return deleted if return_deleted else inserted_ids
 
-        ids_np = np.array(inserted_ids, dtype='int64')
-        idx.add_with_ids(embeddings.astype('float32'), ids_np)
-        self._save_index(collection)
-        conn.close()
+    # Rebuilds with the current index kind, which drops tombstoned vectors.
+    def _purge_in_background(self, collection: str, idx: SegmentedIndex):
+        kind = index_kind(idx.base)
+        storage = self._db(collection).meta().get("storage", "float32")
+        live = idx.ntotal - idx.dead_count
+        if live == 0 or live < training_size(kind, live, storage):
+            kind, storage = "flat", "float16" if storage == "float16" else "float32"
+        idx.rebuild_in_background(kind, storage)
 
-    def search_texts(self, collection: str, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        idx_p = _index_path(collection)
-        if not idx_p.exists():
+    # Closes a collection and deletes its sqlite database and index files.
+    def drop_collection(self, collection: str):
+        if not _meta_path(collection).exists():
+            return
+        db = self._db(collection)
+        meta = db.meta()
+        names = {f"{collection}.index", meta.get("base", f"{collection}.index")} | set(meta.get("segments", []))
+        with self._dbs_lock:
+            self._open_indexes.pop(collection, None)
+            self._dbs.pop(collection, None)
+            db.close()
+        for name in names:
+            (DATA_DIR / name).unlink(missing_ok=True)
+        manifest_path(collection).unlink(missing_ok=True)
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{_meta_path(collection)}{suffix}").unlink(missing_ok=True)
+
+    def search_texts(
+        self,
+        collection: str,
+        query: str,
+        top_k: int = 5,
+        *,
+        where: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rescore: Optional[bool] = None,
+    ) -> List[Dict[str, Any]]:
+        if not _meta_path(collection).exists():
             return []
 
-        q_emb = MODEL.encode([query], convert_to_numpy=True)
-        faiss.normalize_L2(q_emb.astype('float32'))
+        q_emb = _as_float32(embedder.encode([query]))
+        hits = self._dense_search(
+            collection, q_emb, top_k, where=where, nprobe=nprobe, ef_search=ef_search, rescore=rescore
+        )
+        return self._fetch_results(collection, hits)
+
+    # Vector search. With rescoring (the collection's default unless given)
+    # the index only proposes candidates and the final order comes from exact
+    # scores over the float32 vectors in sqlite.
+    def _dense_search(
+        self,
+        collection: str,
+        q_emb: np.ndarray,
+        top_k: int,
+        *,
+        where: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rescore: Optional[bool] = None,
+    ) -> List[Tuple[float, int]]:
+        if rescore is None:
+            rescore = self._db(collection).meta().get("rescore", False)
+        fetch = top_k * RESCORE_FACTOR if rescore else top_k
+        hits = self._candidates(collection, q_emb, fetch, where=where, nprobe=nprobe, ef_search=ef_search)
+        if rescore and hits:
+            ids = np.array([id_ for _, id_ in hits], dtype='int64')
+            hits = self._exact_search(collection, q_emb, top_k, ids) or hits
+        return hits[:top_k]
+
+    # Candidates from the index, optionally restricted to docs whose metadata
+    # matches `where`. The filter is resolved to an id set in sqlite first,
+    # and the strategy is picked by how many docs it matches.
+    def _candidates(
+        self,
+        collection: str,
+        q_emb: np.ndarray,
+        top_k: int,
+        *,
+        where: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+    ) -> List[Tuple[float, int]]:
         idx = self._load_index(collection)
-        D, I = idx.search(q_emb.astype('float32'), top_k)
-        ids = I[0].tolist()
-        conn = sqlite3.connect(str(_meta_path(collection)))
-        cur = conn.cursor()
+        if not where:
+            return idx.search(q_emb, top_k, nprobe=nprobe, ef_search=ef_search)
+
+        ids = self._db(collection).filter_ids(where)
+        if len(ids) == 0:
+            return []
+        fraction = len(ids) / max(idx.ntotal, 1)
+
+        if fraction > FILTER_OVERFETCH_FRACTION:
+            allowed = set(ids.tolist())
+            fetch = int(np.ceil(2 * top_k / fraction))
+            hits = idx.search(q_emb, fetch, nprobe=nprobe, ef_search=ef_search)
+            hits = [hit for hit in hits if hit[1] in allowed][:top_k]
+            if len(hits) >= min(top_k, len(ids)):
+                return hits
+        elif len(ids) <= FILTER_EXACT_LIMIT:
+            hits = self._exact_search(collection, q_emb, top_k, ids)
+            if hits is not None:
+                return hits
+
+        selector = faiss.IDSelectorBatch(ids)
+        hits = idx.search(q_emb, top_k, nprobe=nprobe, ef_search=ef_search, selector=selector)
+        if len(hits) < min(top_k, len(ids)):
+            # graph/cluster search can dead-end on a sparse subset; scan it instead
+            hits = self._exact_search(collection, q_emb, top_k, ids) or hits
+        return hits
+
+    # Brute-force scores over the stored float32 vectors of `ids`; cost is
+    # proportional to the subset. None if some vectors are missing (older
+    # collections that were never rebuilt).
+    def _exact_search(
+        self, collection: str, q_emb: np.ndarray, top_k: int, ids: np.ndarray
+    ) -> Optional[List[Tuple[float, int]]]:
+        found, vectors = self._db(collection).vectors_for_ids(ids)
+        if len(found) < len(ids):
+            return None
+        scores = vectors @ q_emb[0]
+        order = np.argsort(-scores)[:top_k]
+        return [(float(scores[i]), int(found[i])) for i in order]
+
+    # BM25 over the FTS5 index and dense FAISS search run side by side, then
+    # their rankings are merged with reciprocal rank fusion. Each side
+    # contributes its top `candidates` (default 4 * top_k). Result scores are
+    # RRF scores, not cosine similarities.
+    def hybrid_search(
+        self,
+        collection: str,
+        query: str,
+        top_k: int = 5,
+        *,
+        candidates: Optional[int] = None,
+        where: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        if not _meta_path(collection).exists():
+            return []
+        candidates = candidates or 4 * top_k
+        db = self._db(collection)
+
+        lexical = self._pool().submit(db.lexical_search, query, candidates, where)
+        q_emb = _as_float32(embedder.encode([query]))
+        dense_hits = self._dense_search(collection, q_emb, candidates, where=where, nprobe=nprobe, ef_search=ef_search)
+        dense = [id_ for _, id_ in dense_hits]
+        return self._fetch_results(collection, _rrf([dense, lexical.result()])[:top_k])
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._dbs_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="faiss-store")
+        return self._executor
+
+    def _fetch_results(self, collection: str, hits: List[Tuple[float, int]]) -> List[Dict[str, Any]]:
+        if not hits:
+            return []
+
+        rows = self._db(collection).fetch_docs([id_ for _, id_ in hits])
         results = []
-        for score, id_ in zip(D[0].tolist(), ids):
-            if id_ == -1:
-                continue
-            cur.execute("SELECT text, metadata FROM docs WHERE id = ?", (int(id_),))
-            row = cur.fetchone()
+        for score, id_ in hits:
+            row = rows.get(id_)
             if not row:
                 continue
             text, meta_json = row
-            meta = json.loads(meta_json) if meta_json else {}
-            results.append({"id": int(id_), "score": float(score), "text": text, "metadata": meta})
-        conn.close()
-        return results
\ No newline at end of file
+            results.append({"id": id_, "score": score, "text": text, "metadata": LazyMetadata(meta_json)})
+        return results
+
+    # Recall@k of the collection's index against an exact scan of the stored
+    # vectors, plus per-query search latency. Queries are sampled from the
+    # collection itself.
+    def benchmark(
+        self,
+        collection: str,
+        n_queries: int = 100,
+        top_k: int = 10,
+        *,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rescore: Optional[bool] = None,
+    ) -> Dict[str, Any]:
+        db = self._db(collection)
+        idx = self._load_index(collection)
+        if rescore is None:
+            rescore = db.meta().get("rescore", False)
+        max_id = db.max_id()
+        queries = db.sample_vectors(n_queries, max_id)
+        if queries is None or len(queries) == 0:
+            return {"index": index_kind(idx.base), "queries": 0}
+
+        best_scores = np.full((len(queries), top_k), -np.inf, dtype='float32')
+        best_ids = np.full((len(queries), top_k), -1, dtype='int64')
+        for ids, vectors in db.iter_vectors(max_id):
+            scores = np.concatenate([best_scores, queries @ vectors.T], axis=1)
+            cand_ids = np.concatenate([best_ids, np.broadcast_to(ids, (len(queries), len(ids)))], axis=1)
+            keep = np.argpartition(-scores, min(top_k, scores.shape[1] - 1), axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_ids = np.take_along_axis(cand_ids, keep, axis=1)
+
+        latencies, recalls = [], []
+        for query, exact in zip(queries, best_ids):
+            start = time.perf_counter()
+            hits = self._dense_search(
+                collection, query[None, :], top_k, nprobe=nprobe, ef_search=ef_search, rescore=rescore
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+            expected = {int(id_) for id_ in exact if id_ != -1}
+            recalls.append(len(expected & {id_ for _, id_ in hits}) / max(len(expected), 1))
+
+        return {
+            "index": index_kind(idx.base),
+            "storage": storage_kind(idx.base),
+            "index_bytes": idx.nbytes(),
+            "vectors": idx.ntotal,
+            "queries": len(queries),
+            "top_k": top_k,
+            "nprobe": nprobe,
+            "ef_search": ef_search,
+            "rescore": rescore,
+            "recall": float(np.mean(recalls)),
+            "mean_ms": float(np.mean(latencies)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        }
+
+
+_store: Optional[LocalFaissStore] = None
+_store_lock = threading.Lock()
+
+
+# Process-wide store shared by request handlers and threads, so open indexes,
+# sqlite connections and the LRU budget are reused across calls.
+def get_store() -> LocalFaissStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = LocalFaissStore()
+    return _store
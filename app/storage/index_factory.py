@@ -0,0 +1,153 @@
+# Index types supported by LocalFaissStore collections.
+#
+#   flat      exact inner-product scan, cost grows linearly with the collection
+#   ivf_flat  inverted lists over k-means cells, searches `nprobe` cells
+#   ivf_pq    like ivf_flat but stores product-quantized codes (much smaller)
+#   hnsw      graph index, searches with a beam of size `efSearch`
+#
+# Independently of the index type, a collection picks how vectors are stored:
+#
+#   float32   raw vectors (4 bytes per dimension)
+#   float16   half precision, 2x smaller, practically lossless for cosine
+#   sq8       8-bit scalar quantization, 4x smaller
+#   pq        product quantization, 1 byte per 8 dimensions (32x smaller)
+#
+# ivf_pq always stores pq codes. Lossy storage is usually paired with exact
+# rescoring of the top candidates from the float32 copy kept in sqlite.
+#
+# All of them take external ids through add_with_ids so they can be used as the
+# base of a SegmentedIndex.
+import math
+import os
+from typing import Optional
+
+import numpy as np
+import faiss
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+STORAGE_TYPES = ("float32", "float16", "sq8", "pq")
+DEFAULT_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+# faiss warns below ~39 training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+PQ_CENTROIDS = 256
+SQ8_TRAINING_POINTS = 10000
+
+
+def nlist_for(n: int) -> int:
+    return max(1, min(int(4 * math.sqrt(n)), n // MIN_POINTS_PER_CENTROID))
+
+
+def pq_m_for(dim: int) -> int:
+    for m in (dim // 8, dim // 4, dim // 2):
+        if m > 0 and dim % m == 0:
+            return m
+    return 1
+
+
+def effective_storage(index_type: str, storage: str) -> str:
+    return "pq" if index_type == "ivf_pq" else storage
+
+
+def _codec(storage: str, dim: int) -> str:
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGE_TYPES}")
+    return {"float32": "Flat", "float16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{pq_m_for(dim)}"}[storage]
+
+
+def factory_string(index_type: str, dim: int, n: int, storage: str = "float32") -> str:
+    codec = _codec(effective_storage(index_type, storage), dim)
+    if index_type == "flat":
+        return f"IDMap,{codec}"
+    if index_type == "hnsw":
+        return f"IDMap,HNSW{HNSW_M}" + ("" if codec == "Flat" else f"_{codec}")
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return f"IVF{nlist_for(n)},{codec}"
+    raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+
+def training_size(index_type: str, n: int, storage: str = "float32") -> int:
+    storage = effective_storage(index_type, storage)
+    size = 0
+    if index_type in ("ivf_flat", "ivf_pq"):
+        size = nlist_for(n) * MIN_POINTS_PER_CENTROID
+    if storage == "pq":
+        size = max(size, PQ_CENTROIDS * MIN_POINTS_PER_CENTROID)
+    elif storage == "sq8":
+        size = max(size, min(n, SQ8_TRAINING_POINTS))
+    return size
+
+
+def build_index(
+    index_type: str, dim: int, n: int, sample: Optional[np.ndarray] = None, storage: str = "float32"
+) -> faiss.Index:
+    index = faiss.index_factory(dim, factory_string(index_type, dim, n, storage), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        min_points = PQ_CENTROIDS if effective_storage(index_type, storage) == "pq" else 1
+        if sample is None or len(sample) < min_points:
+            raise ValueError(f"{index_type} needs at least {min_points} stored vectors to train")
+        index.train(sample)
+    set_default_search_params(index)
+    return index
+
+
+def _unwrap(index: faiss.Index) -> faiss.Index:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def index_kind(index: faiss.Index) -> str:
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def storage_kind(index: faiss.Index) -> str:
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "float16" if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+
+def set_default_search_params(index: faiss.Index):
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = DEFAULT_NPROBE
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = DEFAULT_EF_SEARCH
+
+
+# Per-query parameters. `selector` restricts the search to a set of external
+# ids; IndexIDMap translates them for the wrapped index.
+# Plain PQ (flat index, pq storage) rejects every SearchParameters, selectors
+# included; callers filter its results themselves.
+def supports_selector(index: faiss.Index) -> bool:
+    return not isinstance(_unwrap(index), faiss.IndexPQ)
+
+
+def search_params(
+    index: faiss.Index,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    selector: Optional[faiss.IDSelector] = None,
+):
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexIVF) and (nprobe is not None or selector is not None):
+        return faiss.SearchParametersIVF(nprobe=nprobe or inner.nprobe, sel=selector)
+    if isinstance(inner, faiss.IndexHNSW) and (ef_search is not None or selector is not None):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or inner.hnsw.efSearch, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
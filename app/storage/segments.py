@@ -0,0 +1,365 @@
+# Append-only segment layout for a FAISS collection.
+#
+# A collection is one base index plus a list of small delta segments. Each
+# add_texts call writes only its own vectors as a new delta, so ingest cost is
+# proportional to the data added. Searches fan out over the base and deltas and
+# merge the per-segment top-k. Compaction folds the deltas into a new base file
+# in the background. The list of live files is kept in the collection's sqlite
+# meta table so a reader never sees a half-written layout.
+#
+# Index files are opened memory-mapped and read-only, so every process serving
+# the same collection shares one copy in the page cache. Writers bump the meta
+# `generation` on each commit; searches compare it with the generation they
+# loaded and reopen the layout when another process has changed it.
+#
+# Deleted docs are tombstoned rather than removed from the index files: their
+# ids are excluded from every search through an IDSelectorNot (applied to the
+# results for plain PQ bases, which take no selector), and a rebuild purges
+# them once they make up enough of the collection.
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import faiss
+
+from app.storage.index_factory import build_index, index_kind, search_params, supports_selector, training_size
+
+logger = logging.getLogger(__name__)
+
+USE_MMAP = os.getenv("FAISS_MMAP", "true") == "true"
+
+
+def write_index_atomic(index: faiss.Index, path: Path):
+    tmp = path.with_name(path.name + ".tmp")
+    faiss.write_index(index, str(tmp))
+    os.replace(tmp, path)
+
+
+def read_index_shared(path: Path, kind: str = "flat") -> faiss.Index:
+    if not USE_MMAP:
+        return faiss.read_index(str(path))
+    # IVF indexes map their inverted lists; flat and HNSW map their vector codes
+    flag = faiss.IO_FLAG_MMAP if kind in ("ivf_flat", "ivf_pq") else faiss.IO_FLAG_MMAP_IFC
+    try:
+        return faiss.read_index(str(path), flag | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        logger.warning("Could not memory-map %s, reading it into memory", path)
+        return faiss.read_index(str(path))
+
+
+def new_flat_index(dim: int) -> faiss.Index:
+    return faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+
+
+def merge_topk(results: List[Tuple[np.ndarray, np.ndarray]], top_k: int) -> List[Tuple[float, int]]:
+    best: dict = {}
+    for scores, ids in results:
+        for score, id_ in zip(scores.tolist(), ids.tolist()):
+            if id_ == -1:
+                continue
+            if id_ not in best or score > best[id_]:
+                best[id_] = score
+    ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [(float(score), int(id_)) for id_, score in ranked]
+
+
+# Search for an index that cannot take a selector: fetch unfiltered, drop
+# the ids the selector rejects, and widen the fetch until top_k survive or
+# the whole index has been ranked.
+def search_filtered(
+    index: faiss.Index, queries: np.ndarray, top_k: int, selector: faiss.IDSelector
+) -> Tuple[np.ndarray, np.ndarray]:
+    fetch = min(index.ntotal, 2 * top_k)
+    while True:
+        D, I = index.search(queries, fetch)
+        keep = [i for i, id_ in enumerate(I[0].tolist()) if id_ != -1 and selector.is_member(id_)]
+        if len(keep) >= top_k or fetch >= index.ntotal:
+            keep = keep[:top_k]
+            return D[0][keep], I[0][keep]
+        fetch = min(index.ntotal, 2 * fetch)
+
+
+class SegmentedIndex:
+    def __init__(self, collection: str, data_dir: Path, db, dim: int):
+        self.collection = collection
+        self.data_dir = data_dir
+        self.db = db
+        self.dim = dim
+        self.lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self.base_name = f"{collection}.index"
+        self.base: faiss.Index = None
+        self.deltas: List[Tuple[str, faiss.Index]] = []
+        self.generation = 0
+        self.dead_count = 0
+        self._dead_ids: Optional[faiss.IDSelector] = None
+        self._dead_selector: Optional[faiss.IDSelector] = None
+        self.reload()
+
+    def _path(self, name: str) -> Path:
+        return self.data_dir / name
+
+    def reload(self):
+        for attempt in range(3):
+            try:
+                return self._reload()
+            except FileNotFoundError:
+                # another process compacted between our meta read and the file
+                # open; its commit is visible now, so read the layout again
+                if attempt == 2:
+                    raise
+
+    def _reload(self):
+        meta = self.db.meta()
+        base_name = meta.get("base", f"{self.collection}.index")
+        base_path = self._path(base_name)
+        with self.lock:
+            loaded = dict(self.deltas)
+            if self.base is not None:
+                loaded[self.base_name] = self.base
+        if base_name not in loaded and not base_path.exists() and "base" not in meta:
+            write_index_atomic(new_flat_index(self.dim), base_path)
+
+        def open_index(name: str, kind: str = "flat") -> faiss.Index:
+            if name in loaded:
+                return loaded[name]
+            if not self._path(name).exists():
+                raise FileNotFoundError(self._path(name))
+            return read_index_shared(self._path(name), kind)
+
+        base = open_index(base_name, meta.get("base_type", "flat"))
+        deltas = [(name, open_index(name)) for name in meta.get("segments", [])]
+        with self.lock:
+            self.base_name, self.base, self.deltas = base_name, base, deltas
+            self.generation = meta.get("generation", 0)
+        self._load_tombstones()
+
+    def _load_tombstones(self):
+        dead = self.db.tombstones()
+        batch = faiss.IDSelectorBatch(dead) if len(dead) else None
+        with self.lock:
+            # the Not selector only points at the batch, so keep both alive
+            self._dead_ids = batch
+            self._dead_selector = faiss.IDSelectorNot(batch) if batch is not None else None
+            self.dead_count = len(dead)
+
+    @property
+    def dead_fraction(self) -> float:
+        with self.lock:
+            return self.dead_count / max(self.ntotal, 1)
+
+    # Freshness check. PRAGMA data_version only reads sqlite's shared-memory
+    # WAL index, so in steady state a search does not touch the disk; the meta
+    # table is read only after some connection has committed.
+    def refresh(self):
+        if not self.db.changed():
+            return
+        generation = self.db.meta().get("generation", 0)
+        if generation != self.generation:
+            self.reload()
+
+    # On-disk size of the live index files, used to bound the store's cache.
+    def nbytes(self) -> int:
+        with self.lock:
+            names = [self.base_name] + [name for name, _ in self.deltas]
+        total = 0
+        for name in names:
+            try:
+                total += self._path(name).stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    @property
+    def ntotal(self) -> int:
+        with self.lock:
+            return self.base.ntotal + sum(seg.ntotal for _, seg in self.deltas)
+
+    def snapshot(self) -> List[faiss.Index]:
+        with self.lock:
+            return [self.base] + [seg for _, seg in self.deltas]
+
+    def _search_state(self) -> Tuple[List[faiss.Index], Optional[faiss.IDSelector], Optional[faiss.IDSelector]]:
+        with self.lock:
+            return self.snapshot(), self._dead_ids, self._dead_selector
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        selector: Optional[faiss.IDSelector] = None,
+    ) -> List[Tuple[float, int]]:
+        self.refresh()
+        indexes, _dead_ids, dead_selector = self._search_state()
+        # an explicit selector comes from live sqlite rows, so it already
+        # excludes tombstoned ids
+        selector = selector or dead_selector
+        results = []
+        for index in indexes:
+            if index.ntotal == 0:
+                continue
+            k = min(top_k, index.ntotal)
+            if selector is not None and not supports_selector(index):
+                results.append(search_filtered(index, queries, k, selector))
+                continue
+            params = search_params(index, nprobe=nprobe, ef_search=ef_search, selector=selector)
+            D, I = index.search(queries, k, params=params)
+            results.append((D[0], I[0]))
+        return merge_topk(results, top_k)
+
+    # Must be called inside the caller's sqlite write transaction; the segment
+    # only becomes visible once that transaction commits and attach() is called.
+    def write_segment(self, embeddings: np.ndarray, ids: np.ndarray) -> Tuple[str, faiss.Index, int]:
+        meta = self.db.meta(self.db.writer)
+        seq = meta.get("next_segment", 0)
+        name = f"{self.collection}.seg{seq}.index"
+        segment = new_flat_index(self.dim)
+        segment.add_with_ids(embeddings, ids)
+        write_index_atomic(segment, self._path(name))
+        generation = meta.get("generation", 0) + 1
+        self.db.set_meta(segments=meta.get("segments", []) + [name], next_segment=seq + 1, generation=generation)
+        return name, segment, generation
+
+    def attach(self, name: str, segment: faiss.Index, generation: int):
+        with self.lock:
+            if generation == self.generation + 1:
+                self.deltas = self.deltas + [(name, segment)]
+                self.generation = generation
+                return
+            if generation == self.generation and name in dict(self.deltas):
+                return
+        # another process committed in between; pick up its changes too
+        self.reload()
+
+    # Publishes `index` as the new base, dropping the deltas it already covers.
+    # `extra_meta` is committed in the same transaction as the swap.
+    def _swap_base(
+        self,
+        index: faiss.Index,
+        old_base_name: str,
+        covered: Set[str],
+        purged: Optional[List[int]] = None,
+        extra_meta: Optional[Dict[str, Any]] = None,
+    ):
+        new_base_name = f"{self.collection}.base{time.time_ns()}.index"
+        base_type = index_kind(index)
+        write_index_atomic(index, self._path(new_base_name))
+        # serve the new base from the shared mapping rather than this heap copy
+        index = read_index_shared(self._path(new_base_name), base_type)
+        with self.db.write_lock:
+            self.db.writer.execute("BEGIN IMMEDIATE")
+            try:
+                meta = self.db.meta(self.db.writer)
+                if meta.get("base", f"{self.collection}.index") != old_base_name:
+                    # another process replaced the base first; drop our result
+                    self.db.writer.rollback()
+                    self._path(new_base_name).unlink(missing_ok=True)
+                    self.reload()
+                    return None
+                generation = meta.get("generation", 0) + 1
+                self.db.set_meta(
+                    **(extra_meta or {}),
+                    base=new_base_name,
+                    base_type=base_type,
+                    segments=[name for name in meta.get("segments", []) if name not in covered],
+                    generation=generation,
+                )
+                if purged:
+                    self.db.clear_tombstones(purged)
+                self.db.writer.commit()
+            except Exception:
+                self.db.writer.rollback()
+                self._path(new_base_name).unlink(missing_ok=True)
+                raise
+            with self.lock:
+                in_sync = generation == self.generation + 1
+                if in_sync:
+                    self.base_name, self.base = new_base_name, index
+                    self.deltas = [d for d in self.deltas if d[0] not in covered]
+                    self.generation = generation
+        if not in_sync:
+            self.reload()
+        elif purged:
+            self._load_tombstones()
+
+        for name in covered | {old_base_name}:
+            self._path(name).unlink(missing_ok=True)
+        return new_base_name
+
+    def compact(self):
+        if not self._compact_lock.acquire(blocking=False):
+            return
+        try:
+            self.refresh()
+            with self.lock:
+                base_name, deltas = self.base_name, list(self.deltas)
+            if not deltas:
+                return
+
+            merged = faiss.read_index(str(self._path(base_name)))
+            for _, segment in deltas:
+                vectors = segment.index.reconstruct_n(0, segment.ntotal)
+                ids = faiss.vector_to_array(segment.id_map).astype('int64')
+                merged.add_with_ids(vectors, ids)
+
+            new_base_name = self._swap_base(merged, base_name, {name for name, _ in deltas})
+            if new_base_name:
+                logger.info("Compacted %d segments into %s", len(deltas), new_base_name)
+        finally:
+            self._compact_lock.release()
+
+    # Builds a fresh base of `index_type` from the float32 vectors stored in
+    # sqlite, which also purges tombstoned vectors. Deltas written while the
+    # rebuild runs are kept as deltas, and so are tombstones for docs deleted
+    # meanwhile.
+    # Returns the new base name, or None if it was not published.
+    def rebuild(
+        self, index_type: str, blocking: bool = True, storage: str = "float32", meta: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        if not self._compact_lock.acquire(blocking=blocking):
+            return None
+        try:
+            self.refresh()
+            with self.db.write_lock:
+                with self.lock:
+                    base_name = self.base_name
+                    covered = {name for name, _ in self.deltas}
+                max_id = self.db.max_id()
+                purged = self.db.tombstones().tolist()
+
+            self.db.backfill_vectors(self.snapshot())
+            n = self.db.count_vectors(max_id)
+            sample = self.db.sample_vectors(training_size(index_type, n, storage), max_id)
+            index = build_index(index_type, self.dim, n, sample, storage)
+            for ids, vectors in self.db.iter_vectors(max_id):
+                index.add_with_ids(vectors, ids)
+
+            new_base_name = self._swap_base(index, base_name, covered, purged, meta)
+            if new_base_name:
+                logger.info(
+                    "Rebuilt %s as %s/%s with %d vectors (%s)", self.collection, index_type, storage, n, new_base_name
+                )
+            return new_base_name
+        finally:
+            self._compact_lock.release()
+
+    def _in_background(self, name: str, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("%s of %s failed", name, self.collection)
+
+        threading.Thread(target=run, name=f"{name}-{self.collection}", daemon=True).start()
+
+    def compact_in_background(self):
+        self._in_background("compact", self.compact)
+
+    def rebuild_in_background(self, index_type: str, storage: str = "float32"):
+        self._in_background("rebuild", self.rebuild, index_type, False, storage)
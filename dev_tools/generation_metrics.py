@@ -0,0 +1,51 @@
+# Counters served on /metrics by the local generation servers.
+import threading
+import time
+from collections import deque
+
+
+class GenerationMetrics:
+    def __init__(self, window_seconds: float = 10.0):
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queue_depth = 0  # requests waiting for a slot
+        self.active = 0  # requests being generated
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.steps = 0
+        self.step_rows = 0
+        self._recent = deque()  # (timestamp, tokens) inside the window
+
+    def tokens(self, n: int):
+        now = time.time()
+        with self.lock:
+            self.generated_tokens += n
+            self._recent.append((now, n))
+            while self._recent and self._recent[0][0] < now - self.window_seconds:
+                self._recent.popleft()
+
+    # One forward pass that produced a token for `rows` requests.
+    def step(self, rows: int):
+        with self.lock:
+            self.steps += 1
+            self.step_rows += rows
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self.lock:
+            recent = sum(n for t, n in self._recent if t >= now - self.window_seconds)
+            span = min(self.window_seconds, now - self.started) or 1.0
+            return {
+                "queue_depth": self.queue_depth,
+                "active": self.active,
+                "requests": self.requests,
+                "errors": self.errors,
+                "prompt_tokens": self.prompt_tokens,
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_second": recent / span,
+                "mean_batch_size": self.step_rows / self.steps if self.steps else 0.0,
+                "uptime_seconds": now - self.started,
+            }
@@ -1,24 +1,32 @@
 import os
-import json
 import uuid
 import traceback
 from pathlib import Path
 from typing import List
 import shutil  # NEW
-import fitz  # PyMuPDF  # NEW
+from concurrent.futures import wait
 
 import gradio as gr
-import requests
-import PyPDF2
 
-from app.storage.faiss_store import LocalFaissStore
+from app.chunking import chunk_pages, chunk_text, iter_pdf_pages
+from app.storage import embedder
+from app.storage.faiss_store import get_store
+from dev_tools import prompting
+from dev_tools.preview_cache import PreviewCache, file_sha256
+from llm.local_llm import LocalLLM, LocalLLMError
 
 # Config (env overrides)
 LOCAL_LLM_URL = os.getenv("LOCAL_LLM_URL", "http://localhost:8080/generate")
 DEFAULT_COLLECTION = os.getenv("FAISS_COLLECTION", None)  # if None, per-session collection
 TOP_K = int(os.getenv("RAG_TOP_K", "4"))
-MAX_CONTEXT_CHARS = int(os.getenv("RAG_MAX_CONTEXT_CHARS", "3000"))
 MAX_NEW_TOKENS = int(os.getenv("RAG_MAX_NEW_TOKENS", "256"))
+HYBRID_SEARCH = os.getenv("RAG_HYBRID_SEARCH", "false") == "true"
+PREVIEW_SCALE = float(os.getenv("RAG_PREVIEW_SCALE", "2.0"))
+PREVIEW_CACHE_MB = int(os.getenv("RAG_PREVIEW_CACHE_MB", "512"))
+PREVIEW_WORKERS = int(os.getenv("RAG_PREVIEW_WORKERS", "2"))
+PREVIEW_PRERENDER = os.getenv("RAG_PREVIEW_PRERENDER", "true") == "true"
+# how long an answer may wait for previews still being rendered
+PREVIEW_WAIT_SECONDS = float(os.getenv("RAG_PREVIEW_WAIT_SECONDS", "0.5"))
 
 # NEW: persistent upload dir (avoid exposing temp paths)
 UPLOAD_DIR = Path(os.getenv("RAG_UPLOAD_DIR", "./data/uploads")).resolve()
@@ -26,60 +34,12 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 PREVIEW_DIR = (UPLOAD_DIR / "previews")  # NEW
 PREVIEW_DIR.mkdir(parents=True, exist_ok=True)  # NEW
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-    text = text or ""
-    if len(text) <= chunk_size:
-        return [text]
-    chunks, start = [], 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        if end == len(text):
-            break
-        start = max(0, end - overlap)
-    return chunks
+# one pooled client shared by all sessions
+LLM = LocalLLM(LOCAL_LLM_URL)
+TOKENS = prompting.TokenCounter(LLM)
 
-def extract_text_from_pdf(path: Path) -> str:
-    reader = PyPDF2.PdfReader(str(path))
-    pages = []
-    for p in reader.pages:
-        try:
-            pages.append(p.extract_text() or "")
-        except Exception:
-            pages.append("")
-    return "\n".join(pages)
-
-# NEW: extract each page separately so we can track page numbers
-def extract_pages_from_pdf(path: Path) -> List[str]:
-    reader = PyPDF2.PdfReader(str(path))
-    pages = []
-    for p in reader.pages:
-        try:
-            pages.append(p.extract_text() or "")
-        except Exception:
-            pages.append("")
-    return pages
-
-# NEW: cached page preview renderer
-def render_pdf_page_preview(pdf_path: Path, page_num: int, scale: float = 2.0) -> Path:
-    """
-    Render given 1-based page num to PNG and return the preview image path.
-    Caches by filename+page.
-    """
-    try:
-        stem = pdf_path.stem
-        out = PREVIEW_DIR / f"{stem}_p{page_num}.png"
-        if out.exists():
-            return out
-        with fitz.open(str(pdf_path)) as doc:
-            if 1 <= page_num <= len(doc):
-                page = doc[page_num - 1]
-                mat = fitz.Matrix(scale, scale)
-                pix = page.get_pixmap(matrix=mat, alpha=False)
-                pix.save(str(out))
-        return out
-    except Exception:
-        return PREVIEW_DIR / f"{pdf_path.stem}_p{page_num}.png"
+# page previews are rendered in worker processes, never on the request path
+PREVIEWS = PreviewCache(PREVIEW_DIR, PREVIEW_CACHE_MB * 1024 * 1024, workers=PREVIEW_WORKERS)
 
 def ensure_collection(state: dict) -> dict:
     state = state or {}
@@ -90,7 +50,7 @@ def ensure_collection(state: dict) -> dict:
 def ingest_files(files: List[gr.File], state: dict, chunk_size: int, overlap: int):
     try:
         state = ensure_collection(state)
-        store = LocalFaissStore()
+        store = get_store()
         store.create_collection(state["collection"])
         total_chunks = 0
         total_files = 0
@@ -114,38 +74,26 @@ def ingest_files(files: List[gr.File], state: dict, chunk_size: int, overlap: in
                 dest = p  # fallback
 
             display_name = dest.name
+            # recorded per chunk so previews never hash the file on the chat path
+            sha256 = file_sha256(dest) if dest.suffix.lower() == ".pdf" else None
 
             texts_to_add: List[str] = []
             metas_to_add: List[dict] = []
 
             if p.suffix.lower() == ".pdf":
-                pages = extract_pages_from_pdf(p)
-                for page_num, page_text in enumerate(pages, start=1):
-                    if not page_text:
-                        continue
-                    chunks = chunk_text(page_text, chunk_size=chunk_size, overlap=overlap)
-                    for i, ch in enumerate(chunks):
-                        texts_to_add.append(ch)
-                        metas_to_add.append({
-                            "source": display_name,
-                            "filepath": str(dest),
-                            "page": page_num,         # NEW: page number (1-based)
-                            "page_chunk": i           # NEW: chunk index within the page
-                        })
+                chunks = chunk_pages(iter_pdf_pages(p), chunk_size=int(chunk_size), overlap=int(overlap))
             else:
-                text = p.read_text(encoding="utf-8", errors="ignore")
-                chunks = chunk_text(text, chunk_size=chunk_size, overlap=overlap)
-                for i, ch in enumerate(chunks):
-                    texts_to_add.append(ch)
-                    metas_to_add.append({
-                        "source": display_name,
-                        "filepath": str(dest),
-                        "page": None,
-                        "page_chunk": i
-                    })
+                chunks = chunk_text(p.read_text(encoding="utf-8", errors="ignore"), chunk_size=int(chunk_size), overlap=int(overlap))
+            for ch in chunks:
+                texts_to_add.append(ch.text)
+                # page (1-based, None for text files), page_chunk and offsets
+                metas_to_add.append(dict(ch.metadata(), source=display_name, filepath=str(dest), sha256=sha256))
 
             if texts_to_add:
                 store.add_texts(state["collection"], texts_to_add, metas_to_add)
+                if PREVIEW_PRERENDER and dest.suffix.lower() == ".pdf":
+                    pages = sorted({m["page"] for m in metas_to_add if m["page"]})
+                    PREVIEWS.prerender(dest, pages, scale=PREVIEW_SCALE, sha256=sha256)
                 total_chunks += len(texts_to_add)
                 total_files += 1
 
@@ -156,98 +104,79 @@ def ingest_files(files: List[gr.File], state: dict, chunk_size: int, overlap: in
         tb = traceback.format_exc(limit=3)
         return f"Ingestion failed: {e}\n{tb}", state or {}
 
-def build_prompt(question: str, contexts: list, max_context_chars: int = MAX_CONTEXT_CHARS) -> str:
-    selected, total = [], 0
-    for c in contexts:
-        txt = (c.get("text") or "").strip()
-        if not txt:
-            continue
-        if total + len(txt) > max_context_chars:
-            remain = max_context_chars - total
-            if remain > 0:
-                selected.append({"text": txt[:remain], "metadata": c.get("metadata", {})})
-            break
-        selected.append({"text": txt, "metadata": c.get("metadata", {})})
-        total += len(txt)
-
-    parts = []
-    for i, c in enumerate(selected, start=1):
-        meta = c.get("metadata", {})
-        src = meta.get("source", "unknown")
-        page = meta.get("page")
-        ck = meta.get("page_chunk", meta.get("chunk", "?"))
-        page_str = f", page={page}" if page else ""
-        parts.append(f"[{i}] Source: {src}{page_str} (chunk={ck})\n{c['text']}")
-    ctx_text = "\n\n---\n\n".join(parts)
+# Merges overlapping chunks and packs them by token count into the server's
+# context window. Returns the prompt and the context blocks it cites as [1], [2], ...
+def build_prompt(question: str, contexts: list, max_new_tokens: int = MAX_NEW_TOKENS):
+    return prompting.assemble_prompt(question, contexts, TOKENS, int(max_new_tokens))
 
-    prompt = (
-        "You are a concise assistant. Use ONLY the CONTEXT to answer the QUESTION.\n\n"
-        f"CONTEXT:\n{ctx_text}\n\n"
-        f"QUESTION:\n{question}\n\n"
-        "INSTRUCTIONS: Answer in one short paragraph. Cite sources inline with [1], [2], etc. "
-        "If the answer is not supported by the context, say \"I don't know based on the provided context.\""
-    )
-    return prompt
-
-def call_llm(prompt: str, max_new_tokens: int = MAX_NEW_TOKENS, temperature: float = 0.0) -> str:
-    payload = {"prompt": prompt, "max_new_tokens": int(max_new_tokens), "temperature": float(temperature)}
+# Yields the answer text as the server streams it; failures end the stream
+# with an error message instead of raising into the UI.
+def stream_llm(prompt: str, max_new_tokens: int = MAX_NEW_TOKENS, temperature: float = 0.0):
     try:
-        r = requests.post(LOCAL_LLM_URL, json=payload, timeout=180)
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, dict) and "text" in data:
-            return str(data["text"]).strip()
-        if isinstance(data, dict) and "generated_text" in data:
-            return str(data["generated_text"]).strip()
-        return json.dumps(data)
-    except requests.RequestException as e:
-        body = ""
-        if getattr(e, "response", None) is not None:
-            try:
-                body = e.response.text
-            except Exception:
-                body = "<no body>"
-        return f"LLM call failed: {e}\n{body}"
+        yield from LLM.stream(prompt, max_new_tokens=int(max_new_tokens), temperature=float(temperature))
+    except LocalLLMError as e:
+        yield f"\n\nLLM call failed: {e}"
 
-# UPDATED: return gallery data + sources lines
+# UPDATED: streams the answer, then adds gallery data + sources lines
 def chat_fn(message: str, history: list, state: dict, top_k: int, max_new_tokens: int):
     state = ensure_collection(state)
     if not state.get("ingested"):
-        return history + [[message, "Please upload and ingest documents first."]], state, [], ""
+        yield history + [[message, "Please upload and ingest documents first."]], state, [], ""
+        return
 
-    store = LocalFaissStore()
-    contexts = store.search_texts(state["collection"], message, top_k=top_k)
+    store = get_store()
+    search = store.hybrid_search if HYBRID_SEARCH else store.search_texts
+    contexts = search(state["collection"], message, top_k=top_k)
     if not contexts:
-        return history + [[message, "No context found. Try another question."]], state, [], ""
+        yield history + [[message, "No context found. Try another question."]], state, [], ""
+        return
+    # from here on `contexts` are the merged blocks the prompt cites
+    prompt, contexts = build_prompt(message, contexts, max_new_tokens)
 
-    prompt = build_prompt(message, contexts)
-    answer = call_llm(prompt, max_new_tokens=max_new_tokens, temperature=0.0)
+    # queue missing previews now so they render while the LLM is generating
+    pending = {}
+    for c in contexts:
+        meta = c.get("metadata", {})
+        fp = Path(meta["filepath"]) if meta.get("filepath") else None
+        page = meta.get("page")
+        if fp and page and fp.exists() and fp.suffix.lower() == ".pdf" and (fp, int(page)) not in pending:
+            pending[(fp, int(page))] = PREVIEWS.submit(fp, int(page), scale=PREVIEW_SCALE, sha256=meta.get("sha256"))
 
-    # Build sources list with page numbers and render previews
-    previews = []
+    # Build sources list with page numbers
     lines = []
     for i, c in enumerate(contexts, start=1):
         meta = c.get("metadata", {})
         src = meta.get("source")
-        fp = Path(meta.get("filepath", "")) if meta.get("filepath") else None
         page = meta.get("page")
-        ck = meta.get("page_chunk", meta.get("chunk"))
+        ck = prompting.chunk_ref(c)
         score = float(c.get("score", 0.0))
-        line = f"[{i}] {src}, page={page} (chunk={ck}) score={score:.4f}" if page else f"[{i}] {src} (chunk={ck}) score={score:.4f}"
-        lines.append(line)
+        lines.append(f"[{i}] {src}, page={page} (chunk={ck}) score={score:.4f}" if page else f"[{i}] {src} (chunk={ck}) score={score:.4f}")
+    sources_md = "\n".join(lines)
 
-        # render preview if we have a file path and page
-        if fp and page and fp.exists() and fp.suffix.lower() == ".pdf":
-            img_path = render_pdf_page_preview(fp, int(page))
-            caption = line
-            previews.append((str(img_path), caption))
+    answer = ""
+    for delta in stream_llm(prompt, max_new_tokens=max_new_tokens, temperature=0.0):
+        answer += delta
+        yield history + [[message, answer]], state, [], sources_md
+    wait(pending.values(), timeout=PREVIEW_WAIT_SECONDS)
 
-    sources_md = "\n".join(lines)
-    answer_full = f"{answer}\n\n---\n{sources_md}"
+    # pages still rendering are skipped; they will be cached next time
+    previews = []
+    for c, line in zip(contexts, lines):
+        meta = c.get("metadata", {})
+        fp = Path(meta["filepath"]) if meta.get("filepath") else None
+        page = meta.get("page")
+        future = pending.get((fp, int(page))) if fp and page else None
+        if future is not None and future.done() and future.exception() is None:
+            previews.append((str(future.result()), line))
 
-    return history + [[message, answer_full]], state, previews, sources_md
+    answer_full = f"{answer.strip()}\n\n---\n{sources_md}"
+    yield history + [[message, answer_full]], state, previews, sources_md
 
 def reset_collection(state: dict):
+    old = (state or {}).get("collection")
+    # per-session collections are never reused, so free their files now
+    if old and old != DEFAULT_COLLECTION:
+        get_store().drop_collection(old)
     state = {"collection": f"gr_{uuid.uuid4().hex[:8]}", "ingested": False}
     return "Session reset. New collection: " + state["collection"], state
 
@@ -294,5 +223,7 @@ with gr.Blocks(title="Local RAG (FAISS + llama.cpp)") as demo:
     )
 
 if __name__ == "__main__":
+    # Warm the embedder while the UI starts; the first ingest or query would load it anyway
+    embedder.preload_in_background()
     # Launch on localhost only
     demo.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
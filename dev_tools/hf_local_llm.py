@@ -1,22 +1,236 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from transformers import pipeline
-import traceback
+from typing import List
+from collections import deque
+from concurrent.futures import Future
+import asyncio, json, os, threading, traceback
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+
+from dev_tools.generation_metrics import GenerationMetrics
 
 app = FastAPI()
 
 # small CPU model for local testing
-GENERATOR = pipeline("text-generation", model="distilgpt2", tokenizer="distilgpt2", device=-1)
+MODEL_NAME = os.getenv("HF_MODEL", "distilgpt2")
+# requests decoded together in one forward pass; 1 serves them one at a time
+MAX_BATCH = int(os.getenv("HF_MAX_BATCH", "16"))
+
+TOKENIZER = AutoTokenizer.from_pretrained(MODEL_NAME)
+MODEL = AutoModelForCausalLM.from_pretrained(MODEL_NAME).eval()
+METRICS = GenerationMetrics()
+
+
+def _layers(cache):
+    if hasattr(cache, "layers"):  # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _cache(layers) -> DynamicCache:
+    cache = DynamicCache()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+
+def _pad_left(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - t.shape[dim]
+    if missing == 0:
+        return t
+    pad = [0, 0] * (t.dim() - 1 - dim) + [missing, 0]
+    return F.pad(t, pad)
+
+
+# Rows are left-padded, so positions have to come from the attention mask.
+def _positions(mask: torch.Tensor) -> torch.Tensor:
+    return (mask.cumsum(-1) - 1).clamp(min=0)
+
+
+class _Request:
+    def __init__(self, ids: list, max_new_tokens: int, on_token=None):
+        self.ids = ids
+        self.max_new_tokens = max_new_tokens
+        self.on_token = on_token  # called from the scheduler thread
+        self.tokens = []
+        self.finished = False
+        self.cancelled = False  # set when a streaming client goes away
+        self.future = Future()
+
+
+class BatchScheduler:
+    """Continuous batching for a causal LM. One thread owns the model and a
+    left-padded batch KV cache. Between decode steps it prefills newly
+    arrived requests and merges them into the batch, and every step decodes
+    one greedy token for all active requests. A request leaves the batch as
+    soon as it emits EOS or reaches its own max_new_tokens."""
+
+    def __init__(self, model, tokenizer, max_batch: int, metrics: GenerationMetrics):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch = max(1, max_batch)
+        self.metrics = metrics
+        self.eos = tokenizer.eos_token_id
+        self.pad = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else self.eos
+        config = model.config
+        self.max_positions = getattr(config, "n_positions", None) or getattr(config, "max_position_embeddings", 1024)
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.active = []  # one per cache row, in cache order
+        self.cache = None
+        self.mask = None
+        threading.Thread(target=self._run, name="batch-scheduler", daemon=True).start()
+
+    def submit(self, prompt: str, max_new_tokens: int, on_token=None) -> _Request:
+        max_new = max(1, min(int(max_new_tokens), self.max_positions // 2))
+        # keep the end of over-long prompts, where the question is
+        ids = self.tokenizer(prompt)["input_ids"][-(self.max_positions - max_new):] or [self.eos]
+        req = _Request(ids, max_new, on_token)
+        with self.cond:
+            self.waiting.append(req)
+            with self.metrics.lock:
+                self.metrics.requests += 1
+                self.metrics.prompt_tokens += len(ids)
+                self.metrics.queue_depth = len(self.waiting)
+            self.cond.notify()
+        return req
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.active:
+                    self.cond.wait()
+                room = self.max_batch - len(self.active)
+                admitted = [self.waiting.popleft() for _ in range(min(room, len(self.waiting)))]
+                with self.metrics.lock:
+                    self.metrics.queue_depth = len(self.waiting)
+            try:
+                with torch.inference_mode():
+                    if admitted:
+                        self._prefill(admitted)
+                    else:
+                        self._decode()
+                    self._retire()
+            except Exception as e:
+                print(traceback.format_exc())
+                failed = self.active + [r for r in admitted if r not in self.active]
+                for r in failed:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                with self.metrics.lock:
+                    self.metrics.errors += len(failed)
+                self.active, self.cache, self.mask = [], None, None
+            with self.metrics.lock:
+                self.metrics.active = len(self.active)
+
+    def _prefill(self, reqs: list):
+        width = max(len(r.ids) for r in reqs)
+        ids = torch.full((len(reqs), width), self.pad, dtype=torch.long)
+        mask = torch.zeros((len(reqs), width), dtype=torch.long)
+        for i, r in enumerate(reqs):
+            ids[i, width - len(r.ids):] = torch.tensor(r.ids)
+            mask[i, width - len(r.ids):] = 1
+        out = self.model(input_ids=ids, attention_mask=mask, position_ids=_positions(mask), use_cache=True)
+        self._join(reqs, out.past_key_values, mask)
+        self._advance(reqs, out.logits[:, -1])
+
+    def _join(self, reqs: list, cache, mask: torch.Tensor):
+        if not self.active:
+            self.cache, self.mask = cache, mask
+        else:
+            length = max(self.mask.shape[1], mask.shape[1])
+            merged = torch.cat([_pad_left(self.mask, length, 1), _pad_left(mask, length, 1)])
+            # drop columns that are padding in every row
+            first = int((merged.sum(0) > 0).nonzero()[0])
+            layers = []
+            for (k1, v1), (k2, v2) in zip(_layers(self.cache), _layers(cache)):
+                k = torch.cat([_pad_left(k1, length, 2), _pad_left(k2, length, 2)])
+                v = torch.cat([_pad_left(v1, length, 2), _pad_left(v2, length, 2)])
+                layers.append((k[:, :, first:], v[:, :, first:]))
+            self.cache, self.mask = _cache(layers), merged[:, first:]
+        self.active = self.active + reqs
+
+    def _decode(self):
+        last = torch.tensor([[r.tokens[-1]] for r in self.active])
+        self.mask = torch.cat([self.mask, torch.ones((len(self.active), 1), dtype=torch.long)], dim=1)
+        out = self.model(
+            input_ids=last,
+            attention_mask=self.mask,
+            position_ids=_positions(self.mask)[:, -1:],
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = out.past_key_values
+        self._advance(self.active, out.logits[:, -1])
+
+    def _advance(self, rows: list, logits: torch.Tensor):
+        produced = 0
+        for r, token in zip(rows, logits.argmax(-1).tolist()):
+            if token == self.eos or r.cancelled:
+                r.finished = True
+                continue
+            r.tokens.append(token)
+            produced += 1
+            r.finished = len(r.tokens) >= r.max_new_tokens
+            if r.on_token is not None:
+                r.on_token(token)
+        self.metrics.tokens(produced)
+        self.metrics.step(len(rows))
+
+    def _retire(self):
+        keep = [i for i, r in enumerate(self.active) if not r.finished]
+        if len(keep) == len(self.active):
+            return
+        for r in self.active:
+            if r.finished:
+                r.future.set_result(self.tokenizer.decode(r.tokens, skip_special_tokens=True))
+        if keep:
+            self.cache.batch_select_indices(torch.tensor(keep))
+            self.mask = self.mask[keep]
+        else:
+            self.cache, self.mask = None, None
+        self.active = [self.active[i] for i in keep]
+
+
+SCHEDULER = BatchScheduler(MODEL, TOKENIZER, MAX_BATCH, METRICS)
 
 class Req(BaseModel):
     prompt: str
     max_new_tokens: int = 128
+    stream: bool = False
+
+# NDJSON lines {"text": delta} as tokens are decoded, then {"done": true}
+# (or {"error": ...} if generation failed part way).
+async def _stream(req: Req):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    request = SCHEDULER.submit(req.prompt, req.max_new_tokens, on_token=lambda t: loop.call_soon_threadsafe(queue.put_nowait, t))
+    request.future.add_done_callback(lambda f: loop.call_soon_threadsafe(queue.put_nowait, None))
+    tokens, sent = [], ""
+    try:
+        while (token := await queue.get()) is not None:
+            tokens.append(token)
+            text = TOKENIZER.decode(tokens, skip_special_tokens=True)
+            # wait for the rest of a multi-byte character
+            if text.endswith("\ufffd") or len(text) == len(sent):
+                continue
+            yield json.dumps({"text": text[len(sent):]}) + "\n"
+            sent = text
+        error = request.future.exception()
+        yield json.dumps({"error": str(error)} if error else {"done": True}) + "\n"
+    finally:
+        request.cancelled = True
 
+# Greedy decoding; the reply is the completion only, without the prompt.
 @app.post("/generate")
-def generate(req: Req):
+async def generate(req: Req):
+    if req.stream:
+        return StreamingResponse(_stream(req), media_type="application/x-ndjson")
     try:
-        out = GENERATOR(req.prompt, max_new_tokens=req.max_new_tokens, do_sample=False)
-        text = out[0].get("generated_text") or out[0].get("text") or str(out[0])
+        text = await asyncio.wrap_future(SCHEDULER.submit(req.prompt, req.max_new_tokens).future)
         return {"text": text}
     except Exception as e:
         tb = traceback.format_exc()
@@ -24,6 +238,19 @@ def generate(req: Req):
         print(tb)
         raise HTTPException(status_code=500, detail={"error": str(e), "trace": tb.splitlines()[-20:]})
 
+class TokenizeReq(BaseModel):
+    texts: List[str]
+
+# Lets clients budget prompts with this model's tokenizer and context size.
+@app.post("/tokenize")
+def tokenize(req: TokenizeReq):
+    ids = TOKENIZER(req.texts, add_special_tokens=False)["input_ids"] if req.texts else []
+    return {"counts": [len(i) for i in ids], "n_ctx": SCHEDULER.max_positions}
+
+@app.get("/metrics")
+def metrics():
+    return METRICS.snapshot()
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8080)
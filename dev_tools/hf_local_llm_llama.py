@@ -1,10 +1,16 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import os, traceback
+from typing import List
+import asyncio, json, os, threading, traceback
+
+from dev_tools.generation_metrics import GenerationMetrics
+from dev_tools.prompting import PROMPT_HEADER
 
 # llama-cpp-python Llama wrapper
 try:
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LlamaRAMCache
     _HAS_LLAMA = True
 except Exception as e:
     print("llama-cpp-python not available:", e)
@@ -14,6 +20,9 @@ app = FastAPI()
 
 MODEL_PATH = os.getenv("LLAMA_MODEL_PATH", "")
 CTX = int(os.getenv("LLAMA_CTX", "2048"))
+# RAM for saved prompt states; 0 disables the cache
+CACHE_MB = int(os.getenv("LLAMA_CACHE_MB", "1024"))
+WARM_HEADER = os.getenv("LLAMA_WARM_HEADER", "true") == "true"
 
 llm = None
 if _HAS_LLAMA:
@@ -27,23 +36,118 @@ if _HAS_LLAMA:
             print("Failed to load llama model:", e)
             llm = None
 
+# llama.cpp already skips re-evaluating the prefix a prompt shares with the
+# previous one. The RAM cache also keeps the KV state of earlier prompts,
+# keyed by their tokens. A request then resumes from the longest cached
+# prefix, e.g. the static PROMPT_HEADER, or a header plus context blocks
+# from an earlier question. Warming stores the header's state before the
+# first request arrives.
+if llm is not None:
+    if CACHE_MB > 0:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=CACHE_MB * 1024 * 1024))
+    if WARM_HEADER:
+        llm(PROMPT_HEADER, max_tokens=1)
+
+# A Llama object holds a single sequence state and is not thread-safe, and the
+# high-level llama-cpp-python API has no batched decoding, so requests are
+# served strictly one at a time in arrival order. Concurrent callers queue
+# here (visible as queue_depth on /metrics); use hf_local_llm.py when
+# aggregate throughput under concurrency matters.
+LLM_LOCK = threading.Lock()
+METRICS = GenerationMetrics()
+
+def _complete(prompt: str, max_tokens: int, on_text=None, cancelled=None) -> dict:
+    with METRICS.lock:
+        METRICS.queue_depth += 1
+    try:
+        with LLM_LOCK:
+            with METRICS.lock:
+                METRICS.queue_depth -= 1
+                METRICS.active = 1
+            try:
+                if on_text is None:
+                    return llm(prompt, max_tokens=max_tokens)
+                # llama-cpp yields one chunk per token; usage is not reported
+                tokens = 0
+                for chunk in llm(prompt, max_tokens=max_tokens, stream=True):
+                    tokens += 1
+                    on_text(chunk["choices"][0]["text"])
+                    if cancelled is not None and cancelled.is_set():
+                        break
+                return {"usage": {"completion_tokens": tokens}}
+            finally:
+                with METRICS.lock:
+                    METRICS.active = 0
+    except Exception:
+        with METRICS.lock:
+            METRICS.errors += 1
+        raise
+
+def _record(resp: dict):
+    usage = resp.get("usage", {})
+    with METRICS.lock:
+        METRICS.requests += 1
+        METRICS.prompt_tokens += usage.get("prompt_tokens", 0)
+    METRICS.tokens(usage.get("completion_tokens", 0))
+
 class Req(BaseModel):
     prompt: str
     max_new_tokens: int = 256
+    stream: bool = False
+
+# NDJSON lines {"text": delta} as llama.cpp produces tokens, then
+# {"done": true} (or {"error": ...} if generation failed part way).
+async def _stream(req: Req):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    emit = lambda text: loop.call_soon_threadsafe(queue.put_nowait, text)
+    job = loop.run_in_executor(None, _complete, req.prompt, req.max_new_tokens, emit, cancelled)
+    job.add_done_callback(lambda f: queue.put_nowait(None))
+    try:
+        while (text := await queue.get()) is not None:
+            if text:
+                yield json.dumps({"text": text}) + "\n"
+        if job.exception() is not None:
+            yield json.dumps({"error": str(job.exception())}) + "\n"
+        else:
+            _record(job.result())
+            yield json.dumps({"done": True}) + "\n"
+    finally:
+        cancelled.set()
 
 @app.post("/generate")
-def generate(req: Req):
+async def generate(req: Req):
     if llm is None:
         raise HTTPException(status_code=500, detail="LLM not initialized or model failed to load")
+    if req.stream:
+        return StreamingResponse(_stream(req), media_type="application/x-ndjson")
     try:
-        resp = llm(req.prompt, max_tokens=req.max_new_tokens)
+        resp = await run_in_threadpool(_complete, req.prompt, req.max_new_tokens)
         text = resp.get("choices", [{}])[0].get("text", "")
+        _record(resp)
         return {"text": text}
     except Exception as e:
         tb = traceback.format_exc()
         print(tb)
         raise HTTPException(status_code=500, detail={"error": str(e), "trace": tb.splitlines()[-20:]})
 
+class TokenizeReq(BaseModel):
+    texts: List[str]
+
+# Lets clients budget prompts with this model's tokenizer and n_ctx. Only the
+# model vocabulary is used, so this does not wait for LLM_LOCK.
+@app.post("/tokenize")
+def tokenize(req: TokenizeReq):
+    if llm is None:
+        raise HTTPException(status_code=500, detail="LLM not initialized or model failed to load")
+    counts = [len(llm.tokenize(t.encode("utf-8"), add_bos=False)) for t in req.texts]
+    return {"counts": counts, "n_ctx": llm.n_ctx()}
+
+@app.get("/metrics")
+def metrics():
+    return METRICS.snapshot()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""Load test for the local /generate servers.
+
+Prompts come from a JSONL file, one object per line, using its "prompt" field
+(or "title" + "body", as in requests.jsonl). They are sent with `concurrency`
+requests in flight, and the latency and throughput are printed along with the
+server's /metrics. Run it once with --concurrency 1 for the single-request
+baseline.
+
+    python -m dev_tools.load_test_llm --file requests.jsonl --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import time
+from itertools import cycle, islice
+
+import httpx
+
+from llm.local_llm import LOCAL_LLM_URL, LocalLLM
+
+
+def load_prompts(path: str) -> list:
+    prompts = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            prompts.append(row.get("prompt") or f"{row.get('title', '')}\n\n{row.get('body', '')}".strip())
+    return prompts
+
+
+def metrics_url(url: str) -> str:
+    return url.rsplit("/", 1)[0] + "/metrics"
+
+
+async def run(url: str, prompts: list, n: int, concurrency: int, max_new_tokens: int) -> dict:
+    client = LocalLLM(url, max_connections=concurrency)
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(prompt: str):
+        async with sem:
+            t0 = time.perf_counter()
+            await client.agenerate(prompt, max_new_tokens=max_new_tokens)
+            latencies.append(time.perf_counter() - t0)
+
+    before = httpx.get(metrics_url(url)).json()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(p) for p in islice(cycle(prompts), n)))
+    elapsed = time.perf_counter() - t0
+    after = httpx.get(metrics_url(url)).json()
+    await client.aclose()
+
+    latencies.sort()
+    tokens = after["generated_tokens"] - before["generated_tokens"]
+    return {
+        "requests": n,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(n / elapsed, 2),
+        "tokens_per_second": round(tokens / elapsed, 1),
+        "latency_p50": round(latencies[len(latencies) // 2], 3),
+        "latency_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+        "server": after,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--url", default=LOCAL_LLM_URL)
+    p.add_argument("--file", default="requests.jsonl", help="JSONL with prompt (or title/body) per line")
+    p.add_argument("--requests", "-n", type=int, default=64)
+    p.add_argument("--concurrency", "-c", type=int, default=16)
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    args = p.parse_args()
+    result = asyncio.run(run(args.url, load_prompts(args.file), args.requests, args.concurrency, args.max_new_tokens))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
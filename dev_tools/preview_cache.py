@@ -0,0 +1,135 @@
+# Bounded, content-addressed cache of rendered PDF page previews.
+#
+# Files are named after the PDF's sha256, the page and the scale, so the same
+# upload under another name reuses its previews and a replaced file never
+# shows stale ones. The sha256 is computed once at ingest and passed in from
+# the chunk metadata; hashing a large PDF on the chat path would bring back the
+# latency this cache exists to remove. Files without a recorded hash fall back
+# to a key made from their path, size and mtime. Rendering runs in a process pool (PyMuPDF is not
+# thread-safe) and off the request path: pages can be queued at ingest time,
+# and chat requests only pick up previews that are already on disk. Once the
+# directory grows past `max_bytes` the least recently used previews are
+# deleted; recency survives restarts through the files' mtimes.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Stand-in for the content hash of files ingested without one: cheap, and it
+# changes whenever the file is replaced.
+def _stat_key(pdf_path: Path) -> str:
+    st = pdf_path.stat()
+    return hashlib.sha256(f"{pdf_path.resolve()}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+
+
+def _render(pdf_path: str, page_num: int, scale: float, out: str) -> str:
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        if not 1 <= page_num <= len(doc):
+            raise ValueError(f"{pdf_path} has no page {page_num}")
+        pix = doc[page_num - 1].get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+        tmp = f"{out}.{os.getpid()}.tmp.png"
+        pix.save(tmp)
+    os.replace(tmp, out)
+    return out
+
+
+class PreviewCache:
+    def __init__(self, root: Path, max_bytes: int, workers: int = 2):
+        root.mkdir(parents=True, exist_ok=True)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._pool = ProcessPoolExecutor(max_workers=max(1, workers))
+        self._pending: Dict[str, Future] = {}
+        # name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        for p in root.glob("*.tmp.png"):  # left by an interrupted render
+            p.unlink(missing_ok=True)
+        for p in sorted(root.glob("*.png"), key=lambda p: p.stat().st_mtime):
+            self._entries[p.name] = p.stat().st_size
+        self._bytes = sum(self._entries.values())
+
+    # `sha256` is the file's content hash as recorded at ingest, if known.
+    def path_for(self, pdf_path: Path, page_num: int, scale: float, sha256: Optional[str] = None) -> Path:
+        key = sha256 or _stat_key(pdf_path)
+        return self.root / f"{key[:32]}_p{page_num}_x{scale:g}.png"
+
+    # Returns the preview if it has been rendered, without rendering it.
+    def get(self, pdf_path: Path, page_num: int, scale: float = 2.0, sha256: Optional[str] = None) -> Optional[Path]:
+        return self._touch(self.path_for(pdf_path, page_num, scale, sha256))
+
+    def _touch(self, out: Path) -> Optional[Path]:
+        with self.lock:
+            if out.name not in self._entries:
+                return None
+            self._entries.move_to_end(out.name)
+        try:
+            os.utime(out)
+        except FileNotFoundError:
+            with self.lock:
+                self._forget(out.name)
+            return None
+        return out
+
+    # Queues the page for rendering unless it is cached or already queued.
+    # The future resolves to the preview path.
+    def submit(self, pdf_path: Path, page_num: int, scale: float = 2.0, sha256: Optional[str] = None) -> Future:
+        out = self.path_for(pdf_path, page_num, scale, sha256)
+        if self._touch(out) is not None:
+            done: Future = Future()
+            done.set_result(out)
+            return done
+        with self.lock:
+            future = self._pending.get(out.name)
+            if future is not None:
+                return future
+            future = self._pool.submit(_render, str(pdf_path), page_num, scale, str(out))
+            self._pending[out.name] = future
+        # outside the lock: runs right here if the render already finished
+        future.add_done_callback(lambda f, name=out.name: self._finished(name, f))
+        return future
+
+    # Queues `pages` of a freshly ingested PDF, e.g. every page that has text.
+    def prerender(self, pdf_path: Path, pages: Iterable[int], scale: float = 2.0, sha256: Optional[str] = None):
+        for page_num in pages:
+            self.submit(pdf_path, page_num, scale, sha256)
+
+    def _finished(self, name: str, future: Future):
+        with self.lock:
+            self._pending.pop(name, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            try:
+                size = (self.root / name).stat().st_size
+            except FileNotFoundError:
+                return
+            self._forget(name)
+            self._entries[name] = size
+            self._bytes += size
+            self._evict()
+
+    def _forget(self, name: str):
+        self._bytes -= self._entries.pop(name, 0)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            (self.root / name).unlink(missing_ok=True)
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
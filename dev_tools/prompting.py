@@ -0,0 +1,201 @@
+# Prompt layout shared by the local RAG tools.
+#
+# Everything that is the same for every question comes first (PROMPT_HEADER),
+# then the retrieved context blocks, then the question. llama.cpp reuses the
+# evaluated KV state of the longest prompt prefix it has seen, so with the
+# static part up front hf_local_llm_llama.py only prefills the per-request text.
+# Keep PROMPT_HEADER byte-for-byte stable: any edit invalidates that cache.
+#
+# Search results are merged before they are packed. Chunks of the same page
+# that overlap or touch become one block, and text already present in
+# another block is dropped. The blocks are then added in rank order until
+# the prompt plus max_new_tokens fills the model's context window, counted
+# with the server's own tokenizer.
+import math
+import os
+from typing import List, Optional, Tuple
+
+from llm.local_llm import LocalLLM, LocalLLMError
+
+PROMPT_HEADER = (
+    "You are a concise assistant. Use ONLY the CONTEXT snippets below to answer the QUESTION.\n"
+    "Answer in one short paragraph. Cite sources inline by bracket number (e.g. [1]). "
+    "Do not invent sources. If the answer is not supported by the context, "
+    "say \"I don't know based on the provided context.\"\n\n"
+    "CONTEXT:\n"
+)
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# Used when the server cannot count tokens (e.g. dev_tools/mock_llm.py).
+FALLBACK_N_CTX = int(os.getenv("RAG_N_CTX", "2048"))
+FALLBACK_CHARS_PER_TOKEN = 3.0  # on the safe side for English BPE vocabularies
+# slack for tokens merging differently across block boundaries
+PROMPT_MARGIN_TOKENS = 16
+# a truncated last block shorter than this is not worth including
+MIN_BLOCK_TOKENS = 32
+# chunks this close (the whitespace the chunker stripped) count as adjacent
+ADJACENT_CHARS = 4
+# shortest suffix/prefix match taken as overlap between chunks without offsets
+MIN_TEXT_OVERLAP = 20
+
+
+class TokenCounter:
+    """Counts tokens with the generation server's tokenizer (POST /tokenize),
+    which also reports the model's context size. Falls back to a conservative
+    characters-per-token estimate when the server has no such endpoint; after
+    the first failed call it stops asking for the life of the counter."""
+
+    def __init__(self, llm: LocalLLM):
+        self.llm = llm
+        self.n_ctx: Optional[int] = None
+        self.supported = True
+
+    def __call__(self, texts: List[str]) -> List[int]:
+        if self.supported:
+            try:
+                resp = self.llm.tokenize(texts)
+                self.n_ctx = resp["n_ctx"]
+                return resp["counts"]
+            # ValueError: a body that is not the expected JSON (e.g. an HTML 404)
+            except (LocalLLMError, KeyError, TypeError, ValueError):
+                self.supported = False
+        self.n_ctx = self.n_ctx or FALLBACK_N_CTX
+        return [math.ceil(len(t) / FALLBACK_CHARS_PER_TOKEN) for t in texts]
+
+
+def chunk_ref(c: dict) -> str:
+    chunks = c.get("chunks")
+    if chunks:
+        return ",".join(str(ck) for ck in chunks)
+    meta = c.get("metadata", {})
+    return str(meta.get("page_chunk", meta.get("chunk", "?")))
+
+
+def context_label(i: int, c: dict) -> str:
+    meta = c.get("metadata", {})
+    src = meta.get("source", "unknown")
+    page = meta.get("page")
+    page_str = f", page={page}" if page else ""
+    return f"[{i}] Source: {src}{page_str} (chunk={chunk_ref(c)})"
+
+
+def _position(c: dict):
+    meta = c["metadata"]
+    return meta.get("start", -1), meta.get("page_chunk", meta.get("chunk", -1)) or 0
+
+
+def _text_overlap(a: str, b: str) -> int:
+    # longest suffix of `a` that is a prefix of `b`
+    probe = b[:MIN_TEXT_OVERLAP]
+    if len(probe) < MIN_TEXT_OVERLAP:
+        return 0
+    pos = a.find(probe, max(0, len(a) - len(b)))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+
+# Merges `b` into `a` (which starts no later than `b`) if they overlap or
+# touch; returns None when they are separate spans.
+def _join(a: dict, b: dict) -> Optional[dict]:
+    ma, mb = a["metadata"], b["metadata"]
+    if b["text"] in a["text"]:
+        text = a["text"]
+    elif "start" in ma and "start" in mb:
+        if mb["start"] > ma["end"] + ADJACENT_CHARS:
+            return None
+        overlap = ma["end"] - mb["start"]
+        text = a["text"] + b["text"][overlap:] if overlap >= 0 else f"{a['text']} {b['text']}"
+    else:
+        overlap = _text_overlap(a["text"], b["text"])
+        if not overlap:
+            return None
+        text = a["text"] + b["text"][overlap:]
+    meta = dict(ma)
+    if "end" in ma and "end" in mb:
+        meta["end"] = max(ma["end"], mb["end"])
+    best = a if a["rank"] <= b["rank"] else b
+    return dict(best, text=text, metadata=meta, rank=best["rank"], chunks=list(dict.fromkeys(a["chunks"] + b["chunks"])))
+
+
+# Collapses search results into non-overlapping blocks, best rank first.
+def merge_contexts(contexts: list) -> List[dict]:
+    groups = {}
+    for rank, c in enumerate(contexts):
+        text = (c.get("text") or "").strip()
+        if not text:
+            continue
+        meta = c.get("metadata") or {}
+        item = dict(c, text=text, metadata=meta, rank=rank, chunks=[meta.get("page_chunk", meta.get("chunk", "?"))])
+        groups.setdefault((meta.get("source"), meta.get("page")), []).append(item)
+
+    blocks = []
+    for items in groups.values():
+        items.sort(key=_position)
+        current = items[0]
+        for item in items[1:]:
+            joined = _join(current, item)
+            if joined is None:
+                blocks.append(current)
+                current = item
+            else:
+                current = joined
+        blocks.append(current)
+    blocks.sort(key=lambda b: b["rank"])
+
+    # the same text can come back under another source name (re-uploads)
+    unique = []
+    for b in blocks:
+        if not any(b["text"] in u["text"] for u in unique):
+            unique.append(b)
+    return unique
+
+
+def _render(i: int, c: dict) -> str:
+    return f"{context_label(i, c)}\n{c['text']}"
+
+
+def _question_part(question: str) -> str:
+    return f"\n\nQUESTION:\n{question}\n\nANSWER:"
+
+
+def build_prompt(question: str, contexts: list) -> str:
+    ctx_text = CONTEXT_SEPARATOR.join(_render(i, c) for i, c in enumerate(contexts, start=1))
+    return f"{PROMPT_HEADER}{ctx_text}{_question_part(question)}"
+
+
+# Keeps blocks, in order, while the prompt plus `max_new_tokens` fits the
+# context window reported by `count_tokens`.
+def pack_contexts(question: str, blocks: List[dict], count_tokens: TokenCounter, max_new_tokens: int) -> List[dict]:
+    rendered = [_render(i, b) + CONTEXT_SEPARATOR for i, b in enumerate(blocks, start=1)]
+    fixed, *sizes = count_tokens([PROMPT_HEADER + _question_part(question)] + rendered)
+    n_ctx = count_tokens.n_ctx or FALLBACK_N_CTX
+    remaining = n_ctx - max_new_tokens - fixed - PROMPT_MARGIN_TOKENS
+    packed = []
+    for block, size in zip(blocks, sizes):
+        if size <= remaining:
+            packed.append(block)
+            remaining -= size
+            continue
+        # cut the first block that does not fit at a word boundary
+        label = count_tokens([context_label(len(packed) + 1, block) + "\n" + CONTEXT_SEPARATOR])[0]
+        room = remaining - label
+        text = block["text"]
+        for _ in range(3):
+            if room < MIN_BLOCK_TOKENS:
+                break
+            text = text[: int(len(text) * room / max(1, count_tokens([text])[0]) * 0.95)].rsplit(" ", 1)[0]
+            if text and count_tokens([text])[0] <= room:
+                packed.append(dict(block, text=text))
+                break
+        break
+    return packed
+
+
+# Merges, packs and renders `contexts`. Returns the prompt and the blocks it
+# cites, in citation order.
+def assemble_prompt(question: str, contexts: list, count_tokens: TokenCounter, max_new_tokens: int) -> Tuple[str, List[dict]]:
+    packed = pack_contexts(question, merge_contexts(contexts), count_tokens, max_new_tokens)
+    return build_prompt(question, packed), packed
@@ -1,28 +1,173 @@
-# Local LLM adapter. If LOCAL_LLM_URL is set, POST {"prompt": "..."} and expect {"text": "..."}.
+# Local LLM adapter. POST {"prompt": "...", ...} to LOCAL_LLM_URL and expect {"text": "..."}.
+#
+# Connections are pooled (one httpx client per LocalLLM for sync calls, one for
+# async calls), connection failures and 502/503/504 answers are retried with
+# backoff, and anything else raises LocalLLMError instead of returning a fake
+# reply. stream()/astream() send "stream": true and yield text deltas from the
+# server's NDJSON lines ({"text": delta} ... {"done": true}); a server that
+# answers with a plain JSON body is yielded as a single delta.
+import asyncio
+import json
 import os
-import requests
-from typing import Dict
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+
+import httpx
 
 LOCAL_LLM_URL = os.getenv("LOCAL_LLM_URL", "http://localhost:8080/generate")
+LOCAL_LLM_TIMEOUT = float(os.getenv("LOCAL_LLM_TIMEOUT", "180"))  # seconds between bytes, not per generation
+LOCAL_LLM_CONNECT_TIMEOUT = float(os.getenv("LOCAL_LLM_CONNECT_TIMEOUT", "5"))
+LOCAL_LLM_RETRIES = int(os.getenv("LOCAL_LLM_RETRIES", "2"))
+LOCAL_LLM_MAX_CONNECTIONS = int(os.getenv("LOCAL_LLM_MAX_CONNECTIONS", "16"))
+
+_RETRY_STATUS = {502, 503, 504}
+_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+
+class LocalLLMError(RuntimeError):
+    pass
+
+
+def _text(data) -> str:
+    # accept different shapes
+    if isinstance(data, dict) and "text" in data:
+        return data["text"]
+    if isinstance(data, dict) and "generated_text" in data:
+        return data["generated_text"]
+    if isinstance(data, str):
+        return data
+    return str(data)
+
+
+def _error(resp: httpx.Response) -> LocalLLMError:
+    return LocalLLMError(f"LLM server returned {resp.status_code}: {resp.text[:2000]}")
+
+
+def _delta(line: str) -> Optional[str]:
+    msg = json.loads(line)
+    if not isinstance(msg, dict):
+        raise LocalLLMError(f"LLM server sent a non-object stream line: {line[:200]}")
+    if "error" in msg:
+        raise LocalLLMError(f"LLM server failed mid-stream: {msg['error']}")
+    return msg.get("text")
+
+
+def _is_stream(resp: httpx.Response) -> bool:
+    return resp.headers.get("content-type", "").startswith("application/x-ndjson")
+
 
 class LocalLLM:
-    def __init__(self, url: str = None):
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        timeout: float = LOCAL_LLM_TIMEOUT,
+        retries: int = LOCAL_LLM_RETRIES,
+        max_connections: int = LOCAL_LLM_MAX_CONNECTIONS,
+    ):
         self.url = url or LOCAL_LLM_URL
+        self.retries = retries
+        http_timeout = httpx.Timeout(timeout, connect=LOCAL_LLM_CONNECT_TIMEOUT)
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.Client(timeout=http_timeout, limits=limits)
+        # bound to the event loop that first uses it
+        self.aclient = httpx.AsyncClient(timeout=http_timeout, limits=limits)
+
+    def _backoff(self, attempt: int) -> float:
+        return 0.5 * 2**attempt
 
     def generate(self, prompt: str, **kwargs) -> str:
-        # If the user configured a real local model server, call it
+        return "".join(self._request({"prompt": prompt, **kwargs, "stream": False}))
+
+    async def agenerate(self, prompt: str, **kwargs) -> str:
+        return "".join([d async for d in self._arequest({"prompt": prompt, **kwargs, "stream": False})])
+
+    # Yields text as the server produces it.
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        return self._request({"prompt": prompt, **kwargs, "stream": True})
+
+    def astream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        return self._arequest({"prompt": prompt, **kwargs, "stream": True})
+
+    # POST /tokenize next to /generate: {"texts": [...]} -> {"counts": [...], "n_ctx": n},
+    # counted with the model's own tokenizer.
+    def tokenize(self, texts: List[str]) -> dict:
+        url = self.url.rsplit("/", 1)[0] + "/tokenize"
         try:
-            resp = requests.post(self.url, json={"prompt": prompt, **kwargs}, timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
-            # accept different shapes
-            if isinstance(data, dict) and "text" in data:
-                return data["text"]
-            if isinstance(data, dict) and "generated_text" in data:
-                return data["generated_text"]
-            if isinstance(data, str):
-                return data
-            return str(data)
-        except Exception:
-            # fallback: simple deterministic mock reply for dev/testing
-            return f"[mock reply] Received prompt of length {len(prompt)}"
\ No newline at end of file
+            resp = self.client.post(url, json={"texts": texts})
+        except httpx.HTTPError as e:
+            raise LocalLLMError(f"tokenize request to {url} failed: {e!r}") from e
+        if resp.is_error:
+            raise _error(resp)
+        return resp.json()
+
+    # Retries only happen before the first delta, so callers never see
+    # repeated text.
+    def _request(self, payload: dict) -> Iterator[str]:
+        started = False
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                with self.client.stream("POST", self.url, json=payload) as resp:
+                    if resp.status_code in _RETRY_STATUS and not last:
+                        resp.read()
+                        time.sleep(self._backoff(attempt))
+                        continue
+                    if resp.is_error:
+                        resp.read()
+                        raise _error(resp)
+                    if not _is_stream(resp):
+                        yield _text(json.loads(resp.read()))
+                        return
+                    for line in resp.iter_lines():
+                        if line.strip():
+                            delta = _delta(line)
+                            if delta:
+                                started = True
+                                yield delta
+                    return
+            except _RETRY_ERRORS as e:
+                if last or started:
+                    raise LocalLLMError(f"LLM request to {self.url} failed: {e!r}") from e
+                time.sleep(self._backoff(attempt))
+            except httpx.HTTPError as e:
+                raise LocalLLMError(f"LLM request to {self.url} failed: {e!r}") from e
+            except ValueError as e:
+                raise LocalLLMError(f"LLM server sent invalid JSON: {e}") from e
+
+    async def _arequest(self, payload: dict) -> AsyncIterator[str]:
+        started = False
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.aclient.stream("POST", self.url, json=payload) as resp:
+                    if resp.status_code in _RETRY_STATUS and not last:
+                        await resp.aread()
+                        await asyncio.sleep(self._backoff(attempt))
+                        continue
+                    if resp.is_error:
+                        await resp.aread()
+                        raise _error(resp)
+                    if not _is_stream(resp):
+                        yield _text(json.loads(await resp.aread()))
+                        return
+                    async for line in resp.aiter_lines():
+                        if line.strip():
+                            delta = _delta(line)
+                            if delta:
+                                started = True
+                                yield delta
+                    return
+            except _RETRY_ERRORS as e:
+                if last or started:
+                    raise LocalLLMError(f"LLM request to {self.url} failed: {e!r}") from e
+                await asyncio.sleep(self._backoff(attempt))
+            except httpx.HTTPError as e:
+                raise LocalLLMError(f"LLM request to {self.url} failed: {e!r}") from e
+            except ValueError as e:
+                raise LocalLLMError(f"LLM server sent invalid JSON: {e}") from e
+
+    def close(self):
+        self.client.close()
+
+    async def aclose(self):
+        await self.aclient.aclose()
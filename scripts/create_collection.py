@@ -38,6 +38,18 @@ async def main(settings: Settings):
         field_schema=models.PayloadSchemaType.KEYWORD,
     )
 
+    await qdrant_client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="document_sha256",
+        field_schema=models.PayloadSchemaType.KEYWORD,
+    )
+
+    await qdrant_client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="ingest_complete",
+        field_schema=models.PayloadSchemaType.BOOL,
+    )
+
 
 if __name__ == "__main__":
     from app.settings import get_settings
@@ -1,15 +1,48 @@
 import argparse
-from app.storage.faiss_store import LocalFaissStore, EMBED_DIM
+import json
+from app.storage.faiss_store import LocalFaissStore
+from app.storage.index_factory import INDEX_TYPES, STORAGE_TYPES
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--collection", "-c", default="colpali_documents", help="collection name")
-    parser.add_argument("--dim", type=int, default=EMBED_DIM, help="embedding dimension (optional)")
+    parser.add_argument("--dim", type=int, default=None, help="embedding dimension (optional, defaults to the embedding model's)")
+    parser.add_argument("--index-type", choices=("auto",) + INDEX_TYPES, default=None,
+                        help="index type; 'auto' (default for new collections) switches from flat to ANN past "
+                             "FAISS_ANN_THRESHOLD vectors. With --rebuild the choice is recorded (default: keep)")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default=None,
+                        help="vector storage (default: float32 for new collections). With --rebuild the collection "
+                             "is re-encoded and the choice is recorded (default: keep)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild an existing collection's index from its stored vectors")
+    parser.add_argument("--benchmark", action="store_true", help="measure recall@k and latency against an exact scan")
+    parser.add_argument("--queries", type=int, default=100, help="number of benchmark queries")
+    parser.add_argument("--top-k", type=int, default=10, help="benchmark k")
+    parser.add_argument("--nprobe", type=int, default=None, help="IVF cells to search (benchmark)")
+    parser.add_argument("--ef-search", type=int, default=None, help="HNSW search beam (benchmark)")
     args = parser.parse_args()
 
     store = LocalFaissStore()
-    store.create_collection(args.collection, dim=args.dim)
-    print(f"Created FAISS collection '{args.collection}' (dim={args.dim}).")
+    if args.rebuild:
+        # the choices go into the collection's meta in the same step as the new base,
+        # otherwise the next load would rebuild it back to the recorded type/storage
+        if args.storage is not None:
+            store.migrate_storage(args.collection, args.storage, index_type=args.index_type)
+        else:
+            updates = {"index_type": args.index_type} if args.index_type else None
+            if store.rebuild_index(args.collection, meta_updates=updates) is None:
+                raise SystemExit(f"'{args.collection}' is already being rebuilt; nothing was changed, retry later.")
+        print(f"Rebuilt FAISS collection '{args.collection}'.")
+    elif not args.benchmark:
+        index_type, storage = args.index_type or "auto", args.storage or "float32"
+        store.create_collection(args.collection, dim=args.dim, index_type=index_type, storage=storage)
+        dim = store.collection_dim(args.collection)
+        print(f"Created FAISS collection '{args.collection}' (dim={dim}, index={index_type}, storage={storage}).")
+
+    if args.benchmark:
+        report = store.benchmark(args.collection, n_queries=args.queries, top_k=args.top_k,
+                                 nprobe=args.nprobe, ef_search=args.ef_search)
+        print(json.dumps(report, indent=2))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
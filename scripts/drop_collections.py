@@ -0,0 +1,28 @@
+import argparse
+from app.storage.faiss_store import LocalFaissStore
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete local FAISS collections and their files")
+    parser.add_argument("collections", nargs="*", help="collections to drop")
+    parser.add_argument("--unused-days", type=float, default=None,
+                        help="also drop collections not written for this many days")
+    parser.add_argument("--prefix", default="", help="only consider collections with this prefix (e.g. gr_)")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be dropped")
+    args = parser.parse_args()
+
+    store = LocalFaissStore()
+    targets = set(args.collections)
+    if args.unused_days is not None:
+        for name in store.get_collections():
+            if name.startswith(args.prefix) and store.collection_age(name) > args.unused_days * 86400:
+                targets.add(name)
+
+    for name in sorted(targets):
+        if args.dry_run:
+            print(f"Would drop '{name}'")
+            continue
+        store.drop_collection(name)
+        print(f"Dropped '{name}'")
+
+if __name__ == "__main__":
+    main()
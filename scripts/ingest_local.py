@@ -1,55 +1,162 @@
 import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
-from typing import List
-
-from app.storage.faiss_store import LocalFaissStore
-import PyPDF2
-
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-    if len(text) <= chunk_size:
-        return [text]
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        if end == len(text):
-            break
-        start = max(0, end - overlap)
-    return chunks
-
-def extract_text_from_pdf(path: Path) -> str:
-    reader = PyPDF2.PdfReader(str(path))
-    pages = []
-    for p in reader.pages:
-        try:
-            pages.append(p.extract_text() or "")
-        except Exception:
-            pages.append("")
-    return "\n".join(pages)
+from typing import Dict, List, Optional, Tuple
+
+from app.chunking import DEFAULT_CHUNK_SIZE, DEFAULT_OVERLAP, UNITS, Chunk, chunk_pages, iter_pdf_pages
+from app.storage import embedder
+from app.storage.faiss_store import LocalFaissStore, manifest_path
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# Runs in a worker process: hash, extract and chunk one file. Only the chunks
+# travel back to the parent, which does all embedding and index writes.
+def extract_file(
+    path: str, chunk_size: int, overlap: int, known_sha: Optional[str] = None, unit: str = "chars"
+) -> Tuple[str, str, Optional[List[Chunk]]]:
+    sha = file_sha256(Path(path))
+    if sha == known_sha:
+        return path, sha, None
+    chunks = list(chunk_pages(iter_pdf_pages(Path(path)), chunk_size=chunk_size, overlap=overlap, unit=unit))
+    return path, sha, chunks
+
+# The manifest maps each ingested file to {size, mtime, sha256, chunks}.
+def load_manifest(path: Path) -> Dict[str, dict]:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(path: Path, manifest: Dict[str, dict]):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp, path)
+
+class BatchWriter:
+    """Collects the chunks of finished files and writes them in one go once
+    `batch_size` chunks are pending, so the model sees large batches no matter
+    how small the individual files are. Each batch is a single upsert: one
+    transaction and one delta segment, however many files it covers."""
+
+    def __init__(self, store: LocalFaissStore, collection: str, manifest: Dict[str, dict], manifest_file: Path, batch_size: int):
+        self.store = store
+        self.collection = collection
+        self.manifest = manifest
+        self.manifest_file = manifest_file
+        self.batch_size = batch_size
+        self.pending: List[Tuple[str, dict, List[Chunk]]] = []
+        self.pending_chunks = 0
+        self.total = 0
+
+    def add(self, source: str, entry: dict, chunks: List[Chunk]):
+        self.pending.append((source, entry, chunks))
+        self.pending_chunks += len(chunks)
+        if self.pending_chunks >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        texts = [c.text for _, _, chunks in self.pending for c in chunks]
+        metadatas = [dict(c.metadata(), source=source) for source, _, chunks in self.pending for c in chunks]
+        embeddings = embedder.encode_documents(texts, show_progress_bar=False) if texts else None
+        sources = [source for source, _, _ in self.pending]
+        # replaces whatever earlier versions of these files left behind
+        self.store.upsert(self.collection, texts, metadatas, where={"source": sources}, embeddings=embeddings)
+        for source, entry, chunks in self.pending:
+            self.manifest[source] = dict(entry, chunks=len(chunks))
+        self.total += len(texts)
+        save_manifest(self.manifest_file, self.manifest)
+        self.pending, self.pending_chunks = [], 0
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--path", "-p", required=True, help="PDF file or folder to ingest")
     parser.add_argument("--collection", "-c", default="colpali_documents")
-    parser.add_argument("--chunk_size", type=int, default=1000)
-    parser.add_argument("--overlap", type=int, default=200)
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--overlap", type=int, default=DEFAULT_OVERLAP, help="at most this much trailing text (whole sentences) is repeated")
+    parser.add_argument("--unit", choices=UNITS, default="chars", help="measure chunk_size/overlap in characters or embedding-model tokens")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes extracting and chunking files")
+    parser.add_argument("--embed-batch", type=int, default=4096, help="chunks embedded and written per batch")
+    parser.add_argument("--recursive", "-r", action="store_true", help="also ingest PDFs in subfolders")
+    parser.add_argument("--prune", action="store_true", help="remove chunks of manifest files that no longer exist")
+    parser.add_argument("--force", action="store_true", help="re-ingest files even if the manifest says they are unchanged")
+    parser.add_argument("--manifest", type=Path, default=None, help="defaults to faiss_data/<collection>.manifest.json")
     args = parser.parse_args()
 
     path = Path(args.path)
     store = LocalFaissStore()
     store.create_collection(args.collection)
+    manifest_file = args.manifest or manifest_path(args.collection)
+    # --force only skips the unchanged checks; entries of files outside --path
+    # must survive in the manifest
+    manifest = load_manifest(manifest_file)
 
-    files = [path] if path.is_file() else list(path.glob("*.pdf"))
-    total = 0
+    if path.is_file():
+        files = [path]
+    else:
+        files = sorted(path.rglob("*.pdf") if args.recursive else path.glob("*.pdf"))
+
+    # cheap check first: same size and mtime means the file was not touched
+    todo = []
     for f in files:
-        print(f"Ingesting {f}")
-        text = extract_text_from_pdf(f)
-        chunks = chunk_text(text, chunk_size=args.chunk_size, overlap=args.overlap)
-        metadatas = [{"source": str(f), "chunk": i} for i in range(len(chunks))]
-        store.add_texts(args.collection, chunks, metadatas)
-        total += len(chunks)
-    print(f"Ingested {total} chunks into collection '{args.collection}'")
+        source = str(f)
+        st = f.stat()
+        entry = {"size": st.st_size, "mtime": st.st_mtime}
+        known = None if args.force else manifest.get(source)
+        if known and known["size"] == entry["size"] and known["mtime"] == entry["mtime"]:
+            continue
+        todo.append((source, entry, known["sha256"] if known else None))
+    print(f"{len(files) - len(todo)} of {len(files)} files unchanged, {len(todo)} to check")
+
+    writer = BatchWriter(store, args.collection, manifest, manifest_file, args.embed_batch)
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        entries = {}
+        in_flight = set()
+        queue = iter(todo)
+        while True:
+            # bounded so extracted chunks cannot pile up faster than we embed
+            for source, entry, known_sha in queue:
+                future = pool.submit(extract_file, source, args.chunk_size, args.overlap, known_sha, args.unit)
+                entries[future] = (source, entry)
+                in_flight.add(future)
+                if len(in_flight) >= 2 * max(1, args.workers):
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, entry = entries.pop(future)
+                try:
+                    _, sha, chunks = future.result()
+                except Exception as e:
+                    print(f"Skipping {source}: {e}")
+                    continue
+                entry["sha256"] = sha
+                if chunks is None:
+                    # touched but identical content: only refresh size/mtime
+                    manifest[source].update(entry)
+                    continue
+                print(f"Ingesting {source} ({len(chunks)} chunks)")
+                writer.add(source, entry, chunks)
+    writer.flush()
+
+    if args.prune and not path.is_file():
+        root = str(path)
+        for source in [s for s in manifest if s.startswith(root) and not Path(s).exists()]:
+            removed = store.delete_by_metadata(args.collection, {"source": source})
+            print(f"Pruned {source} ({removed} chunks)")
+            del manifest[source]
+    save_manifest(manifest_file, manifest)
+    print(f"Ingested {writer.total} chunks into collection '{args.collection}'")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,29 @@
+import argparse
+import json
+from app.storage.faiss_store import LocalFaissStore
+from app.storage.index_factory import INDEX_TYPES, STORAGE_TYPES
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encode local FAISS collections with a different vector storage")
+    parser.add_argument("collections", nargs="*", help="collections to migrate (default: all)")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, required=True, help="new vector storage")
+    parser.add_argument("--index-type", choices=("auto",) + INDEX_TYPES, default=None,
+                        help="also change the index type (default: keep)")
+    rescore = parser.add_mutually_exclusive_group()
+    rescore.add_argument("--rescore", dest="rescore", action="store_true", default=None,
+                         help="re-rank candidates with exact float32 scores")
+    rescore.add_argument("--no-rescore", dest="rescore", action="store_false")
+    parser.add_argument("--benchmark", action="store_true", help="report recall and latency after migrating")
+    args = parser.parse_args()
+
+    store = LocalFaissStore()
+    for name in args.collections or store.get_collections():
+        before = store.index_bytes(name)
+        store.migrate_storage(name, args.storage, index_type=args.index_type, rescore=args.rescore)
+        after = store.index_bytes(name)
+        print(f"Migrated '{name}' to {args.storage}: {before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB")
+        if args.benchmark:
+            print(json.dumps(store.benchmark(name), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import os
 
 from app.api.endpoints import pdf_ingest, query
 from app.api.lifespan import lifespan
+from app.settings import get_settings, use_local_storage
 
 app = FastAPI(lifespan=lifespan)
 
@@ -16,16 +17,11 @@ app.add_middleware(
 )
 
 # --- backend selection (ADDED) ---
-STORAGE_MODE = os.getenv("STORAGE_MODE", "auto").lower()
 LLM_MODE = os.getenv("LLM_MODE", "auto").lower()
-SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
 
-use_local_storage = False
-if STORAGE_MODE == "local":
-    use_local_storage = True
-elif STORAGE_MODE == "auto" and not SUPABASE_KEY:
-    use_local_storage = True
+# same rule the lifespan uses to pick the vector store
+local_storage = use_local_storage(get_settings())
 
 use_local_llm = False
 if LLM_MODE == "local":
@@ -33,7 +29,7 @@ if LLM_MODE == "local":
 elif LLM_MODE == "auto" and not ANTHROPIC_API_KEY:
     use_local_llm = True
 
-if use_local_storage:
+if local_storage:
     from storage.local_storage import upload_file, download_file, list_files, delete_file
     # You may need to adapt names where server used supabase client methods
 else:
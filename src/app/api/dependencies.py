@@ -5,8 +5,11 @@ from fastapi import Request
 from instructor import AsyncInstructor
 from qdrant_client import AsyncQdrantClient
 
+from app.services.admission import AdmissionLimiter, ModelGate
+from app.services.answer_cache import AnswerCache
 from app.services.img_downloader import SupabaseJPEGDownloader
 from app.services.img_uploader import SupabaseJPEGUploader
+from app.settings import IngestSettings, StreamSettings, get_settings
 from app.utils.prompt_utils import read_prompt_from_plain_file
 
 
@@ -38,6 +41,34 @@ async def get_instructor_client(request: Request) -> AsyncInstructor:
     return request.state.instructor_client
 
 
+async def get_ingest_limiter(request: Request) -> AdmissionLimiter:
+    return request.state.ingest_limiter
+
+
+async def get_query_limiter(request: Request) -> AdmissionLimiter:
+    return request.state.query_limiter
+
+
+async def get_model_gate(request: Request) -> ModelGate:
+    return request.state.model_gate
+
+
+async def get_answer_cache(request: Request) -> AnswerCache | None:
+    return request.state.answer_cache
+
+
+async def get_prompt_cache(request: Request) -> bool:
+    return request.state.prompt_cache
+
+
+async def get_ingest_settings() -> IngestSettings:
+    return get_settings().ingest
+
+
+async def get_stream_settings() -> StreamSettings:
+    return get_settings().stream
+
+
 @lru_cache(maxsize=1)
 def get_prompts():
     prompt1 = read_prompt_from_plain_file("prompts/response_1")
@@ -1,3 +1,4 @@
+from contextlib import suppress
 from typing import Annotated
 from uuid import uuid4
 
@@ -6,19 +7,28 @@ from colpali_engine.models import ColQwen2_5, ColQwen2_5_Processor
 from fastapi import APIRouter, Depends, UploadFile
 from fastapi.concurrency import run_in_threadpool
 from loguru import logger
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
 from pydantic import UUID4
 from qdrant_client import AsyncQdrantClient, models
 
 from app.api.dependencies import (
+    get_answer_cache,
     get_collection_name,
     get_colpali_model,
     get_colpali_processor,
+    get_ingest_limiter,
+    get_ingest_settings,
+    get_model_gate,
     get_qdrant_client,
     get_supabase_uploader,
 )
+from app.services.admission import AdmissionLimiter, ModelGate, Priority
+from app.services.answer_cache import AnswerCache
 from app.services.img_uploader import SupabaseJPEGUploader
+from app.settings import IngestSettings
 from app.utils.qdrant_utils import upsert_with_retry
+from app.utils.upload_utils import SpooledUpload, spool_upload
 
 router = APIRouter()
 
@@ -31,81 +41,214 @@ class PDFIngestController:
         uploader: SupabaseJPEGUploader,
         qdrant_client: AsyncQdrantClient,
         collection_name: str,
+        settings: IngestSettings,
+        model_gate: ModelGate,
+        answer_cache: AnswerCache | None,
     ):
         self.model = model
         self.processor = processor
         self.uploader = uploader
         self.qdrant_client = qdrant_client
         self.collection_name = collection_name
+        self.settings = settings
+        self.model_gate = model_gate
+        self.answer_cache = answer_cache
+
+    def embed_images(self, images: list[Image.Image]) -> torch.Tensor:
+        with torch.inference_mode():
+            processed_images = self.processor.process_images(images).to(
+                self.model.device
+            )
+            return self.model(**processed_images)
+
+    def document_filter(
+        self, session_id: UUID4, sha256: str, complete: bool = False
+    ) -> models.Filter:
+        conditions = [
+            models.FieldCondition(
+                key="session_id",
+                match=models.MatchValue(value=str(session_id)),
+            ),
+            models.FieldCondition(
+                key="document_sha256",
+                match=models.MatchValue(value=sha256),
+            ),
+        ]
+        if complete:
+            conditions.append(
+                models.FieldCondition(
+                    key="ingest_complete",
+                    match=models.MatchValue(value=True),
+                )
+            )
+        return models.Filter(must=conditions)
+
+    # Only documents whose every page was stored count; pages left behind by
+    # an ingest that failed part way never carry the completion marker.
+    async def is_duplicate(self, session_id: UUID4, sha256: str) -> bool:
+        response = await self.qdrant_client.count(
+            collection_name=self.collection_name,
+            count_filter=self.document_filter(
+                session_id=session_id, sha256=sha256, complete=True
+            ),
+            exact=True,
+        )
+        return response.count > 0
+
+    async def mark_complete(self, session_id: UUID4, sha256: str) -> None:
+        await self.qdrant_client.set_payload(
+            collection_name=self.collection_name,
+            payload={"ingest_complete": True},
+            points=models.FilterSelector(
+                filter=self.document_filter(
+                    session_id=session_id, sha256=sha256
+                )
+            ),
+            wait=True,
+        )
+
+    async def delete_document(self, session_id: UUID4, sha256: str) -> None:
+        await self.qdrant_client.delete(
+            collection_name=self.collection_name,
+            points_selector=models.FilterSelector(
+                filter=self.document_filter(
+                    session_id=session_id, sha256=sha256
+                )
+            ),
+            wait=True,
+        )
+
+    async def ingest_document(
+        self,
+        upload: SpooledUpload,
+        file_name: str | None,
+        session_id: UUID4,
+    ) -> int:
+        batch_size = 1
+        render_window = max(self.settings.render_window, batch_size)
+
+        info = await run_in_threadpool(
+            pdfinfo_from_path, pdf_path=str(upload.path)
+        )
+        num_images = int(info["Pages"])
+        total_batches = (num_images + batch_size - 1) // batch_size
+
+        # Rasterize a bounded window of pages at a time so memory does not
+        # grow with the size of the PDF.
+        for window_start in range(0, num_images, render_window):
+            images = await run_in_threadpool(
+                convert_from_path,
+                pdf_path=str(upload.path),
+                dpi=self.settings.dpi,
+                first_page=window_start + 1,
+                last_page=min(window_start + render_window, num_images),
+                thread_count=4,
+                fmt="jpeg",
+            )
+
+            for offset in range(0, len(images), batch_size):
+                start_idx = window_start + offset
+                batch = images[offset : offset + batch_size]
+
+                async with self.model_gate.access(Priority.BULK):
+                    batch_embeddings = await run_in_threadpool(
+                        self.embed_images, batch
+                    )
+
+                points = []
+                for batch_offset, embedding in enumerate(batch_embeddings):
+                    page_number = start_idx + batch_offset + 1
+                    payload = {
+                        "session_id": session_id,
+                        "document": file_name,
+                        "document_sha256": upload.sha256,
+                        "page": page_number,
+                    }
+                    vector = embedding.cpu().float().numpy().tolist()
+                    point = models.PointStruct(
+                        id=str(uuid4()),
+                        vector=vector,
+                        payload=payload,
+                    )
+                    points.append(point)
+
+                await upsert_with_retry(
+                    qdrant_client=self.qdrant_client,
+                    collection_name=self.collection_name,
+                    points=points,
+                )
+
+                await self.uploader.upload_images(
+                    session_id=session_id,
+                    file_name=file_name or "unknown",
+                    images=batch,
+                    start=start_idx + 1,
+                )
+
+                logger.info(
+                    "Processed batch {batch_num}/{total_batches} for file {filename}",
+                    batch_num=start_idx // batch_size + 1,
+                    total_batches=total_batches,
+                    filename=file_name,
+                )
+
+        return num_images
 
     async def ingest(
         self, files: list[UploadFile], session_id: UUID4
     ) -> dict[str, list[dict[str, str | int | None]]]:
-        results = []
-        batch_size = 1
+        results: list[dict[str, str | int | None]] = []
+        seen: set[str] = set()
 
         for file in files:
             try:
-                pdf_bytes = await file.read()
-                images = await run_in_threadpool(
-                    convert_from_bytes,
-                    pdf_file=pdf_bytes,
-                    dpi=300,
-                    thread_count=4,
-                    fmt="jpeg",
-                )
-                num_images = len(images)
-                total_batches = (num_images + batch_size - 1) // batch_size
-
-                for batch_idx, start_idx in enumerate(
-                    range(0, num_images, batch_size)
-                ):
-                    end_idx = start_idx + batch_size
-                    batch = images[start_idx:end_idx]
-
-                    with torch.inference_mode():
-                        processed_images = self.processor.process_images(
-                            batch
-                        ).to(self.model.device)
-                        batch_embeddings = self.model(**processed_images)
-
-                    points = []
-                    for offset, (_, embedding) in enumerate(
-                        zip(batch, batch_embeddings)
+                async with spool_upload(
+                    file=file,
+                    chunk_size=self.settings.upload_chunk_size,
+                    spool_dir=self.settings.spool_dir,
+                ) as upload:
+                    if upload.sha256 in seen or await self.is_duplicate(
+                        session_id=session_id, sha256=upload.sha256
                     ):
-                        page_number = start_idx + offset + 1
-                        payload = {
-                            "session_id": session_id,
-                            "document": file.filename,
-                            "page": page_number,
-                        }
-                        vector = embedding.cpu().float().numpy().tolist()
-                        point = models.PointStruct(
-                            id=str(uuid4()),
-                            vector=vector,
-                            payload=payload,
+                        logger.info(
+                            "Skipping duplicate file {filename} ({sha256})",
+                            filename=file.filename,
+                            sha256=upload.sha256,
                         )
-                        points.append(point)
-
-                    await upsert_with_retry(
-                        qdrant_client=self.qdrant_client,
-                        collection_name=self.collection_name,
-                        points=points,
-                    )
-
-                    await self.uploader.upload_images(
-                        session_id=session_id,
-                        file_name=file.filename or "unknown",
-                        images=batch,
-                        start=start_idx + 1,
-                    )
+                        results.append(
+                            {
+                                "filename": file.filename,
+                                "sha256": upload.sha256,
+                                "status": "duplicate",
+                            }
+                        )
+                        continue
+                    seen.add(upload.sha256)
 
-                    logger.info(
-                        "Processed batch {batch_num}/{total_batches} for file {filename}",
-                        batch_num=batch_idx + 1,
-                        total_batches=total_batches,
-                        filename=file.filename,
-                    )
+                    try:
+                        # pages left by an earlier, incomplete ingest
+                        await self.delete_document(
+                            session_id=session_id, sha256=upload.sha256
+                        )
+                        num_images = await self.ingest_document(
+                            upload=upload,
+                            file_name=file.filename,
+                            session_id=session_id,
+                        )
+                        await self.mark_complete(
+                            session_id=session_id, sha256=upload.sha256
+                        )
+                    except Exception:
+                        with suppress(Exception):
+                            await self.delete_document(
+                                session_id=session_id, sha256=upload.sha256
+                            )
+                        raise
+                    finally:
+                        if self.answer_cache is not None:
+                            self.answer_cache.invalidate_session(
+                                str(session_id)
+                            )
 
                 results.append(
                     {"filename": file.filename, "num_pages": num_images}
@@ -129,6 +272,10 @@ async def ingest_pdf(
     uploader: Annotated[SupabaseJPEGUploader, Depends(get_supabase_uploader)],
     qdrant_client: Annotated[AsyncQdrantClient, Depends(get_qdrant_client)],
     collection_name: Annotated[str, Depends(get_collection_name)],
+    settings: Annotated[IngestSettings, Depends(get_ingest_settings)],
+    model_gate: Annotated[ModelGate, Depends(get_model_gate)],
+    limiter: Annotated[AdmissionLimiter, Depends(get_ingest_limiter)],
+    answer_cache: Annotated[AnswerCache | None, Depends(get_answer_cache)],
 ):
     controller = PDFIngestController(
         model=model,
@@ -136,5 +283,9 @@ async def ingest_pdf(
         uploader=uploader,
         qdrant_client=qdrant_client,
         collection_name=collection_name,
+        settings=settings,
+        model_gate=model_gate,
+        answer_cache=answer_cache,
     )
-    return await controller.ingest(files=files, session_id=session_id)
+    async with limiter.slot():
+        return await controller.ingest(files=files, session_id=session_id)
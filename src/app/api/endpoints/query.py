@@ -1,28 +1,61 @@
-from typing import Annotated, Any, AsyncIterator
+import json
+from dataclasses import dataclass
+from typing import Annotated, Any, AsyncIterator, Literal
 
 import torch
 from colpali_engine.models import ColQwen2_5, ColQwen2_5_Processor
 from fastapi import APIRouter, Depends
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from instructor import AsyncInstructor
-from pydantic import UUID4
+from loguru import logger
+from pydantic import UUID4, ValidationError
 from qdrant_client import AsyncQdrantClient, models
 
 from app.api.dependencies import (
+    get_answer_cache,
     get_collection_name,
     get_colpali_model,
     get_colpali_processor,
     get_instructor_client,
+    get_model_gate,
+    get_prompt_cache,
     get_prompts,
     get_qdrant_client,
+    get_query_limiter,
+    get_stream_settings,
     get_supabase_downloader,
 )
-from app.models.query_response import FinalResponse
+from app.models.query_response import (
+    FinalResponse,
+    RetrievalEvent,
+    RetrievedPage,
+)
+from app.services.admission import (
+    AdmissionLimiter,
+    AdmittedStreamingResponse,
+    ModelGate,
+    Priority,
+)
+from app.services.answer_cache import AnswerCache, prepare_query_embedding
 from app.services.img_downloader import SupabaseJPEGDownloader
+from app.settings import StreamSettings, get_settings
+from app.utils.prompt_utils import build_query_messages
+from app.utils.sse_utils import (
+    ResponseDeltaEncoder,
+    format_sse,
+    with_heartbeats,
+)
 
 router = APIRouter()
 
 
+@dataclass(frozen=True)
+class Retrieval:
+    pages: list[RetrievedPage]
+    query_embedding: torch.Tensor
+    cache_generation: int
+
+
 class QueryController:
     def __init__(
         self,
@@ -33,6 +66,9 @@ class QueryController:
         qdrant_client: AsyncQdrantClient,
         collection_name: str,
         prompts: dict[str, str],
+        model_gate: ModelGate,
+        answer_cache: AnswerCache | None,
+        prompt_cache: bool = False,
     ) -> None:
         self.model = model
         self.processor = processor
@@ -41,15 +77,28 @@ class QueryController:
         self.qdrant_client = qdrant_client
         self.collection_name = collection_name
         self.prompts = prompts
+        self.model_gate = model_gate
+        self.answer_cache = answer_cache
+        self.prompt_cache = prompt_cache
 
-    async def query(
-        self, query: str, top_k: int, session_id: UUID4
-    ) -> AsyncIterator[Any]:
+    def embed_query(self, query: str) -> torch.Tensor:
         with torch.inference_mode():
             processed_queries = self.processor.process_queries(
                 queries=[query]
             ).to(self.model.device)
-            query_embeddings = self.model(**processed_queries)
+            return self.model(**processed_queries)
+
+    async def retrieve(
+        self, query: str, top_k: int, session_id: UUID4
+    ) -> Retrieval:
+        cache_generation = (
+            self.answer_cache.generation(str(session_id))
+            if self.answer_cache is not None
+            else 0
+        )
+
+        async with self.model_gate.access(Priority.INTERACTIVE):
+            query_embeddings = await run_in_threadpool(self.embed_query, query)
 
         search_results = await self.qdrant_client.query_points(
             collection_name=self.collection_name,
@@ -66,39 +115,133 @@ class QueryController:
             search_params=models.SearchParams(hnsw_ef=128, exact=False),
         )
 
-        points = [point.payload for point in search_results.points]
-        filenames = [
-            f"{point['session_id']}/{point['document']}/{point['page']}.jpeg"
-            for point in points
-            if point
-        ]
+        pages = []
+        for point in search_results.points:
+            payload = point.payload
+            if not payload:
+                continue
+            pages.append(
+                RetrievedPage(
+                    filename=f"{payload['session_id']}/{payload['document']}/{payload['page']}.jpeg",
+                    document=payload["document"],
+                    page=payload["page"],
+                    score=point.score,
+                )
+            )
+        return Retrieval(
+            pages=pages,
+            query_embedding=query_embeddings[0],
+            cache_generation=cache_generation,
+        )
+
+    async def answer(
+        self, query: str, session_id: UUID4, retrieval: Retrieval
+    ) -> AsyncIterator[Any]:
+        filenames = [page.filename for page in retrieval.pages]
+        page_set = frozenset(filenames)
+        query_embedding = None
+        if self.answer_cache is not None:
+            query_embedding = prepare_query_embedding(retrieval.query_embedding)
+            cached = self.answer_cache.lookup(
+                session_id=str(session_id),
+                pages=page_set,
+                query=query,
+                embedding=query_embedding,
+            )
+            if cached is not None:
+                logger.info(
+                    "Answer cache hit for session {session_id}",
+                    session_id=session_id,
+                )
+                yield cached
+                return
+
         instructor_images = await self.downloader.download_instructor_images(
             filenames=filenames
         )
 
-        prompt_1 = self.prompts["prompt1"]
-        prompt_2 = self.prompts["prompt2"]
-
-        query_content: list[str | object] = [prompt_1]
-        for filename, image in zip(filenames, instructor_images):
-            query_content.extend(
-                [f'\t<image file="{filename}">', image, "\t</image>"]
-            )
-        query_content.append(prompt_2)
+        system, messages = build_query_messages(
+            prompts=self.prompts,
+            filenames=filenames,
+            images=instructor_images,
+            cache_prefix=self.prompt_cache,
+        )
 
         stream = self.instructor_client.completions.create_partial(
-            model="claude-3-7-sonnet-latest",
+            model=get_settings().anthropic.model,
             response_model=FinalResponse,
-            messages=[{"role": "user", "content": query_content}],  # type: ignore
+            system=system,
+            messages=messages,  # type: ignore
             context={"query": query},
             temperature=0.0,
             max_tokens=8192,
             max_retries=3,
         )
 
+        last_partial = None
         async for partial in stream:
+            last_partial = partial
+            yield partial
+
+        if (
+            self.answer_cache is None
+            or query_embedding is None
+            or last_partial is None
+        ):
+            return
+        try:
+            response = FinalResponse.model_validate(last_partial.model_dump())
+        except ValidationError:
+            return
+        self.answer_cache.store(
+            session_id=str(session_id),
+            pages=page_set,
+            query=query,
+            embedding=query_embedding,
+            response=response,
+            generation=retrieval.cache_generation,
+        )
+
+    async def query(
+        self, query: str, top_k: int, session_id: UUID4
+    ) -> AsyncIterator[Any]:
+        retrieval = await self.retrieve(
+            query=query, top_k=top_k, session_id=session_id
+        )
+        async for partial in self.answer(
+            query=query, session_id=session_id, retrieval=retrieval
+        ):
             yield partial.model_dump_json() + "\n"
 
+    async def query_sse(
+        self, query: str, top_k: int, session_id: UUID4
+    ) -> AsyncIterator[str]:
+        try:
+            retrieval = await self.retrieve(
+                query=query, top_k=top_k, session_id=session_id
+            )
+            yield format_sse(
+                event="retrieval",
+                data=RetrievalEvent(pages=retrieval.pages).model_dump_json(),
+            )
+
+            deltas = ResponseDeltaEncoder()
+            async for partial in self.answer(
+                query=query, session_id=session_id, retrieval=retrieval
+            ):
+                for event, data in deltas.update(partial):
+                    yield format_sse(event=event, data=data)
+            for event, data in deltas.finish():
+                yield format_sse(event=event, data=data)
+            yield format_sse(event="done", data="{}")
+        except Exception as e:
+            logger.error(
+                "Error streaming answer for session {session_id}: {error}",
+                session_id=session_id,
+                error=str(e),
+            )
+            yield format_sse(event="error", data=json.dumps({"error": str(e)}))
+
 
 @router.post("/query/")
 async def query_endpoint(
@@ -116,6 +259,12 @@ async def query_endpoint(
     qdrant_client: Annotated[AsyncQdrantClient, Depends(get_qdrant_client)],
     collection_name: Annotated[str, Depends(get_collection_name)],
     prompts: Annotated[dict[str, str], Depends(get_prompts)],
+    model_gate: Annotated[ModelGate, Depends(get_model_gate)],
+    limiter: Annotated[AdmissionLimiter, Depends(get_query_limiter)],
+    answer_cache: Annotated[AnswerCache | None, Depends(get_answer_cache)],
+    stream_settings: Annotated[StreamSettings, Depends(get_stream_settings)],
+    prompt_cache: Annotated[bool, Depends(get_prompt_cache)],
+    stream_format: Literal["ndjson", "sse"] = "ndjson",
 ):
     controller = QueryController(
         model=model,
@@ -125,8 +274,30 @@ async def query_endpoint(
         qdrant_client=qdrant_client,
         collection_name=collection_name,
         prompts=prompts,
+        model_gate=model_gate,
+        answer_cache=answer_cache,
+        prompt_cache=prompt_cache,
     )
-    return StreamingResponse(
-        controller.query(query, top_k, session_id),
-        media_type="text/event-stream",
-    )
+    await limiter.acquire()
+    try:
+        if stream_format == "sse":
+            return AdmittedStreamingResponse(
+                with_heartbeats(
+                    stream=controller.query_sse(query, top_k, session_id),
+                    interval=stream_settings.heartbeat_interval,
+                ),
+                limiter=limiter,
+                media_type="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                },
+            )
+        return AdmittedStreamingResponse(
+            controller.query(query, top_k, session_id),
+            limiter=limiter,
+            media_type="text/event-stream",
+        )
+    except BaseException:
+        limiter.release()
+        raise
@@ -1,21 +1,26 @@
 from contextlib import asynccontextmanager
 from typing import AsyncIterator, TypedDict
 
-import instructor
 from colpali_engine.models import ColQwen2_5, ColQwen2_5_Processor
 from fastapi import FastAPI
 from instructor import AsyncInstructor
+from loguru import logger
 from qdrant_client import AsyncQdrantClient
 
+from app.api.dependencies import get_prompts
 from app.api.state import (
     create_anthropic_client,
+    create_instructor_client,
     create_qdrant_client,
     create_supabase_client,
 )
 from app.colpali.loaders import ColQwen2_5Loader
+from app.services.admission import AdmissionLimiter, ModelGate
+from app.services.answer_cache import AnswerCache
 from app.services.img_downloader import SupabaseJPEGDownloader
 from app.services.img_uploader import SupabaseJPEGUploader
 from app.settings import get_settings
+from app.utils.prompt_utils import MIN_CACHEABLE_TOKENS, count_prefix_tokens
 
 
 class State(TypedDict):
@@ -26,6 +31,11 @@ class State(TypedDict):
     instructor_client: AsyncInstructor
     qdrant_client: AsyncQdrantClient
     collection_name: str
+    ingest_limiter: AdmissionLimiter
+    query_limiter: AdmissionLimiter
+    model_gate: ModelGate
+    answer_cache: AnswerCache | None
+    prompt_cache: bool
 
 
 @asynccontextmanager
@@ -33,7 +43,9 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
     settings = get_settings()
     qdrant_client = create_qdrant_client(settings=settings)
     anthropic_client = create_anthropic_client(settings=settings)
-    instructor_client = instructor.from_anthropic(client=anthropic_client)
+    instructor_client = create_instructor_client(
+        anthropic_client=anthropic_client
+    )
     supabase_client = create_supabase_client(settings=settings)
     supabase_uploader = SupabaseJPEGUploader(
         client=supabase_client, bucket_name=settings.supabase.bucket
@@ -43,6 +55,49 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
     )
     loader = ColQwen2_5Loader(model_name=settings.colpali.colpali_model_name)
     model, processor = loader.load()
+    admission = settings.admission
+    ingest_limiter = AdmissionLimiter(
+        name="ingest",
+        max_concurrency=admission.ingest_max_concurrency,
+        max_queue=admission.ingest_max_queue,
+        queue_timeout=admission.queue_timeout,
+        retry_after=admission.retry_after,
+    )
+    query_limiter = AdmissionLimiter(
+        name="query",
+        max_concurrency=admission.query_max_concurrency,
+        max_queue=admission.query_max_queue,
+        queue_timeout=admission.queue_timeout,
+        retry_after=admission.retry_after,
+    )
+    model_gate = ModelGate(max_concurrency=admission.model_max_concurrency)
+    answer_cache = (
+        AnswerCache(
+            similarity_threshold=settings.answer_cache.similarity_threshold,
+            max_entries=settings.answer_cache.max_entries,
+        )
+        if settings.answer_cache.enabled
+        else None
+    )
+
+    try:
+        prefix_tokens = await count_prefix_tokens(
+            client=anthropic_client,
+            model=settings.anthropic.model,
+            system=get_prompts()["prompt1"],
+        )
+    except Exception as e:
+        logger.warning(
+            "Could not count prompt prefix tokens, caching disabled: {error}",
+            error=str(e),
+        )
+        prefix_tokens = 0
+    prompt_cache = prefix_tokens >= MIN_CACHEABLE_TOKENS
+    logger.info(
+        "Prompt prefix is {tokens} tokens, caching {state}",
+        tokens=prefix_tokens,
+        state="enabled" if prompt_cache else "disabled",
+    )
 
     yield {
         "model": model,
@@ -52,6 +107,11 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
         "instructor_client": instructor_client,
         "qdrant_client": qdrant_client,
         "collection_name": settings.qdrant.collection_name,
+        "ingest_limiter": ingest_limiter,
+        "query_limiter": query_limiter,
+        "model_gate": model_gate,
+        "answer_cache": answer_cache,
+        "prompt_cache": prompt_cache,
     }
 
     await qdrant_client.close()
@@ -1,11 +1,24 @@
+from typing import cast
+
+import instructor
 from anthropic import AsyncAnthropic
+from instructor import AsyncInstructor
 from qdrant_client import AsyncQdrantClient
 from supabase.client import AsyncClient as SupabaseAsyncClient
 
-from app.settings import Settings
+from app.services.multivector_store import LocalMultiVectorClient
+from app.settings import Settings, use_local_storage
+from app.utils.llm_usage import record_usage
 
 
 def create_qdrant_client(settings: Settings) -> AsyncQdrantClient:
+    if use_local_storage(settings):
+        # Implements the subset of AsyncQdrantClient the controllers use.
+        local_client = LocalMultiVectorClient(
+            data_dir=settings.storage.multivector_dir,
+            prefilter=settings.storage.multivector_prefilter,
+        )
+        return cast(AsyncQdrantClient, local_client)
     return AsyncQdrantClient(
         url=settings.qdrant.qdrant_url,
         api_key=settings.qdrant.qdrant_api_key,
@@ -21,3 +34,18 @@ def create_supabase_client(settings: Settings) -> SupabaseAsyncClient:
 
 def create_anthropic_client(settings: Settings) -> AsyncAnthropic:
     return AsyncAnthropic(api_key=settings.anthropic.api_key)
+
+
+def create_instructor_client(
+    anthropic_client: AsyncAnthropic,
+) -> AsyncInstructor:
+    # Same as instructor.from_anthropic, but with a create function that logs
+    # token usage, including prompt cache reads and writes.
+    mode = instructor.Mode.ANTHROPIC_TOOLS
+    create = record_usage(create=anthropic_client.messages.create)
+    return AsyncInstructor(
+        client=anthropic_client,
+        create=instructor.patch(create=create, mode=mode),
+        provider=instructor.Provider.ANTHROPIC,
+        mode=mode,
+    )
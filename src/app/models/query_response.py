@@ -16,3 +16,14 @@ class FinalResponse(BaseModel):
     answer: str = Field(
         description="The complete answer text based solely on the provided context. The answer must include in-text citations in the format [id] corresponding to the references."
     )
+
+
+class RetrievedPage(BaseModel):
+    filename: str
+    document: str
+    page: int
+    score: float
+
+
+class RetrievalEvent(BaseModel):
+    pages: list[RetrievedPage]
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Any, AsyncIterator
+
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+from loguru import logger
+from starlette.types import Receive, Scope, Send
+
+
+class AdmissionRejected(HTTPException):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class AdmissionLimiter:
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float,
+        retry_after: int,
+    ) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    async def acquire(self) -> None:
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            logger.warning(
+                "Rejecting {name} request: {waiting} already queued",
+                name=self.name,
+                waiting=self._waiting,
+            )
+            raise AdmissionRejected(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Too many {self.name} requests, retry later",
+                retry_after=self.retry_after,
+            )
+
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(), timeout=self.queue_timeout
+            )
+        except TimeoutError:
+            logger.warning(
+                "Timed out waiting {timeout}s for a {name} slot",
+                timeout=self.queue_timeout,
+                name=self.name,
+            )
+            raise AdmissionRejected(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"No {self.name} capacity available, retry later",
+                retry_after=self.retry_after,
+            )
+        finally:
+            self._waiting -= 1
+
+    def release(self) -> None:
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    # Releases the limiter slot once the response is over: sent in full,
+    # failed, or abandoned by a client that disconnected before the body
+    # generator was ever started.
+    def __init__(
+        self, content: Any, limiter: AdmissionLimiter, **kwargs: Any
+    ) -> None:
+        super().__init__(content, **kwargs)
+        self.limiter = limiter
+
+    async def __call__(
+        self, scope: Scope, receive: Receive, send: Send
+    ) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class ModelGate:
+    def __init__(self, max_concurrency: int = 1) -> None:
+        self._available = max_concurrency
+        self._waiters: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+
+    @asynccontextmanager
+    async def access(self, priority: Priority) -> AsyncIterator[None]:
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: Priority) -> None:
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            return
+
+        future: asyncio.Future[None] = (
+            asyncio.get_running_loop().create_future()
+        )
+        entry = (int(priority), next(self._counter), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before cancellation.
+                self._release()
+            elif entry in self._waiters:
+                # _release() may already have popped and skipped it.
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._available += 1
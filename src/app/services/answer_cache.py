@@ -0,0 +1,148 @@
+import itertools
+import re
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import torch
+
+from app.models.query_response import FinalResponse
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+# Capitalized or all-caps words, without a trailing possessive
+_ENTITY = re.compile(r"[A-Z][\w&-]*")
+_SENTENCE_START = re.compile(r"(?:^|[.!?]\s+)[\"'(]*([A-Za-z][\w&-]*)")
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    pages: frozenset[str]
+    query: str
+    facts: frozenset[str]
+    embedding: torch.Tensor
+    response: FinalResponse
+
+
+def normalize_query(query: str) -> str:
+    # Case, spacing and trailing punctuation do not change the question.
+    text = " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+    return text.rstrip("?!. ")
+
+
+def query_facts(query: str) -> frozenset[str]:
+    # Numbers and named entities a paraphrase has to keep. Embeddings barely
+    # move between "revenue in 2020" and "revenue in 2021", so two questions
+    # are only interchangeable when these match exactly.
+    text = unicodedata.normalize("NFKC", query)
+    starts = {m.start(1) for m in _SENTENCE_START.finditer(text)}
+    numbers = {m.group().replace(",", "") for m in _NUMBER.finditer(text)}
+    entities = {
+        m.group().casefold()
+        for m in _ENTITY.finditer(text)
+        if m.start() not in starts or m.group().isupper()
+    }
+    return frozenset(numbers | entities)
+
+
+def prepare_query_embedding(embedding: torch.Tensor) -> torch.Tensor:
+    # One unit vector per query token, kept off the model's device
+    return torch.nn.functional.normalize(embedding.float(), dim=-1).cpu()
+
+
+def query_similarity(a: torch.Tensor, b: torch.Tensor) -> float:
+    # Symmetric MaxSim: every token of each query has to find a close token
+    # in the other, averaged per query so length does not inflate the score.
+    sim = a @ b.T
+    forward = sim.max(dim=1).values.mean()
+    backward = sim.max(dim=0).values.mean()
+    return float(torch.minimum(forward, backward))
+
+
+class AnswerCache:
+    """Answers keyed on the session and the retrieved page set, looked up by
+    question.
+
+    A question hits when its normalized text matches a cached one, or when
+    it is a near-duplicate: the MaxSim similarity of the two ColQwen query
+    embeddings reaches `similarity_threshold` and both name the same numbers
+    and entities.
+
+    The cache lives in process memory: every uvicorn worker keeps its own
+    copy and only sees invalidations from ingests it served itself, so enable
+    it only when the API runs with a single worker.
+    """
+
+    def __init__(self, similarity_threshold: float, max_entries: int) -> None:
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self._sessions: dict[str, dict[int, CachedAnswer]] = {}
+        self._lru: OrderedDict[tuple[str, int], None] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self._ids = itertools.count()
+
+    def generation(self, session_id: str) -> int:
+        return self._generations.get(session_id, 0)
+
+    def lookup(
+        self,
+        session_id: str,
+        pages: frozenset[str],
+        query: str,
+        embedding: torch.Tensor,
+    ) -> FinalResponse | None:
+        normalized = normalize_query(query)
+        facts = query_facts(query)
+        best_id, best_score = None, self.similarity_threshold
+        entries = self._sessions.get(session_id, {})
+        for entry_id, entry in entries.items():
+            if entry.pages != pages:
+                continue
+            if entry.query == normalized:
+                best_id = entry_id
+                break
+            if entry.facts != facts:
+                continue
+            score = query_similarity(entry.embedding, embedding)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            return None
+        self._lru.move_to_end((session_id, best_id))
+        return entries[best_id].response
+
+    def store(
+        self,
+        session_id: str,
+        pages: frozenset[str],
+        query: str,
+        embedding: torch.Tensor,
+        response: FinalResponse,
+        generation: int,
+    ) -> None:
+        # An ingest finished while this answer was being generated, so it may
+        # already be stale.
+        if generation != self.generation(session_id):
+            return
+
+        entry_id = next(self._ids)
+        self._sessions.setdefault(session_id, {})[entry_id] = CachedAnswer(
+            pages=pages,
+            query=normalize_query(query),
+            facts=query_facts(query),
+            embedding=embedding,
+            response=response,
+        )
+        self._lru[(session_id, entry_id)] = None
+
+        while len(self._lru) > self.max_entries:
+            (old_session, old_id), _ = self._lru.popitem(last=False)
+            old_entries = self._sessions[old_session]
+            del old_entries[old_id]
+            if not old_entries:
+                del self._sessions[old_session]
+
+    def invalidate_session(self, session_id: str) -> None:
+        self._generations[session_id] = self.generation(session_id) + 1
+        for entry_id in self._sessions.pop(session_id, {}):
+            self._lru.pop((session_id, entry_id), None)
@@ -0,0 +1,325 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from qdrant_client import models
+from qdrant_client.http.models import QueryResponse
+
+_FILTER_KEY = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# Token rows copied out of the memory map and scored at a time, so memory
+# stays bounded when every page of a large collection is a candidate.
+SCORE_BATCH_ROWS = 65536
+
+
+def _filter_sql(query_filter: models.Filter | None) -> tuple[str, list[Any]]:
+    if query_filter is None:
+        return "1", []
+    if query_filter.should or query_filter.must_not:
+        raise NotImplementedError("Only 'must' filters are supported locally")
+    conditions = query_filter.must or []
+    if not isinstance(conditions, list):
+        conditions = [conditions]
+
+    clauses, params = [], []
+    for condition in conditions:
+        if not (
+            isinstance(condition, models.FieldCondition)
+            and isinstance(condition.match, models.MatchValue)
+            and _FILTER_KEY.fullmatch(condition.key)
+        ):
+            raise NotImplementedError(
+                f"Unsupported filter condition for local storage: {condition}"
+            )
+        clauses.append(f"json_extract(payload, '$.{condition.key}') = ?")
+        params.append(condition.match.value)
+    return " AND ".join(clauses) or "1", params
+
+
+def _selector_filter(selector: Any) -> models.Filter:
+    if isinstance(selector, models.FilterSelector):
+        return selector.filter
+    if isinstance(selector, models.Filter):
+        return selector
+    raise NotImplementedError("Only filter selectors are supported locally")
+
+
+def _pool(vectors: np.ndarray) -> np.ndarray:
+    pooled = vectors.astype(np.float32).mean(axis=0)
+    return pooled / max(float(np.linalg.norm(pooled)), 1e-12)
+
+
+def maxsim_scores(
+    query: np.ndarray, tokens: np.ndarray, starts: np.ndarray
+) -> np.ndarray:
+    """MaxSim of one query against many pages whose token vectors are
+    concatenated in `tokens`; page i starts at row `starts[i]`."""
+    similarities = query @ tokens.T
+    per_page_max = np.maximum.reduceat(similarities, starts, axis=1)
+    return per_page_max.sum(axis=0)
+
+
+def _batches(lengths: list[int], max_rows: int) -> list[tuple[int, int]]:
+    """Splits consecutive pages into [lo, hi) ranges of at most `max_rows`
+    token rows; a single longer page gets a range of its own."""
+    ranges, lo, total = [], 0, 0
+    for i, length in enumerate(lengths):
+        if i > lo and total + length > max_rows:
+            ranges.append((lo, i))
+            lo, total = i, 0
+        total += length
+    if lo < len(lengths):
+        ranges.append((lo, len(lengths)))
+    return ranges
+
+
+class _MultiVectorCollection:
+    """One collection on disk: every page's token vectors appended to a
+    single float16 file (memory-mapped for search) and a sqlite table with
+    each point's payload, its row range in that file and a mean-pooled
+    vector for the prefilter."""
+
+    def __init__(self, path: Path) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = path / "vectors.f16"
+        self.vectors_path.touch(exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            str(path / "points.db"), check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS points (id TEXT PRIMARY KEY,"
+            " payload TEXT, start INTEGER, length INTEGER, pooled BLOB)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)"
+        )
+        for key in ("session_id", "document_sha256"):
+            self.db.execute(
+                f"CREATE INDEX IF NOT EXISTS points_{key}"
+                f" ON points (json_extract(payload, '$.{key}'))"
+            )
+        self.db.commit()
+        self._mmap: np.memmap | None = None
+
+    def _meta(self, key: str, default: int) -> int:
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else int(row[0])
+
+    def _tokens(self, rows: int, dim: int) -> np.ndarray:
+        if self._mmap is None or self._mmap.shape[0] < rows:
+            self._mmap = np.memmap(
+                self.vectors_path, dtype=np.float16, mode="r", shape=(rows, dim)
+            )
+        return self._mmap
+
+    def upsert(self, points: list[models.PointStruct]) -> None:
+        pages = [np.asarray(point.vector, dtype=np.float32) for point in points]
+        with self.lock:
+            dim = self._meta("dim", pages[0].shape[1])
+            start = self._meta("rows", 0)
+            rows = []
+            with open(self.vectors_path, "r+b") as f:
+                # anything past `rows` is left over from a failed write
+                f.seek(start * dim * 2)
+                for point, page in zip(points, pages):
+                    f.write(page.astype(np.float16).tobytes())
+                    rows.append(
+                        (
+                            str(point.id),
+                            json.dumps(point.payload or {}, default=str),
+                            start,
+                            len(page),
+                            _pool(page).tobytes(),
+                        )
+                    )
+                    start += len(page)
+                f.truncate()
+                f.flush()
+            self.db.executemany(
+                "INSERT OR REPLACE INTO points"
+                " (id, payload, start, length, pooled) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("dim", dim), ("rows", start)],
+            )
+            self.db.commit()
+
+    # Token rows of deleted points are left unused in the vectors file.
+    def delete(self, query_filter: models.Filter) -> None:
+        condition, params = _filter_sql(query_filter)
+        with self.lock:
+            self.db.execute(f"DELETE FROM points WHERE {condition}", params)
+            self.db.commit()
+
+    def set_payload(
+        self, payload: dict[str, Any], query_filter: models.Filter
+    ) -> None:
+        condition, params = _filter_sql(query_filter)
+        with self.lock:
+            self.db.execute(
+                "UPDATE points SET payload = json_patch(payload, ?)"
+                f" WHERE {condition}",
+                [json.dumps(payload, default=str), *params],
+            )
+            self.db.commit()
+
+    def count(self, query_filter: models.Filter | None) -> int:
+        condition, params = _filter_sql(query_filter)
+        with self.lock:
+            return self.db.execute(
+                f"SELECT COUNT(*) FROM points WHERE {condition}", params
+            ).fetchone()[0]
+
+    def query(
+        self,
+        query: np.ndarray,
+        limit: int,
+        query_filter: models.Filter | None,
+        prefilter: int,
+    ) -> list[models.ScoredPoint]:
+        condition, params = _filter_sql(query_filter)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, payload, start, length, pooled FROM points"
+                f" WHERE {condition}",
+                params,
+            ).fetchall()
+            if not rows:
+                return []
+            tokens = self._tokens(self._meta("rows", 0), query.shape[1])
+
+        if prefilter and len(rows) > prefilter:
+            pooled = np.frombuffer(
+                b"".join(row[4] for row in rows), dtype=np.float32
+            ).reshape(len(rows), -1)
+            coarse = pooled @ _pool(query)
+            keep = np.argpartition(-coarse, prefilter)[:prefilter]
+            rows = [rows[i] for i in keep]
+
+        scores = np.empty(len(rows), dtype=np.float32)
+        for lo, hi in _batches([row[3] for row in rows], SCORE_BATCH_ROWS):
+            batch = rows[lo:hi]
+            batch_tokens = np.concatenate(
+                [tokens[row[2] : row[2] + row[3]] for row in batch]
+            ).astype(np.float32)
+            starts = np.cumsum([0] + [row[3] for row in batch[:-1]])
+            scores[lo:hi] = maxsim_scores(query, batch_tokens, starts)
+
+        order = np.argsort(-scores)[:limit]
+        return [
+            models.ScoredPoint(
+                id=rows[i][0],
+                version=0,
+                score=float(scores[i]),
+                payload=json.loads(rows[i][1]),
+            )
+            for i in order
+        ]
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+            self._mmap = None
+
+
+class LocalMultiVectorClient:
+    """Service-free stand-in for the part of AsyncQdrantClient used by the
+    ingest and query controllers (upsert, delete, set_payload, query_points,
+    count). Scores pages
+    by exact MaxSim over float16 token vectors, optionally restricted to the
+    `prefilter` pages whose mean-pooled vectors best match the query."""
+
+    def __init__(self, data_dir: str, prefilter: int = 0) -> None:
+        self.data_dir = Path(data_dir)
+        self.prefilter = prefilter
+        self._collections: dict[str, _MultiVectorCollection] = {}
+        self._lock = threading.Lock()
+
+    def _collection(self, name: str) -> _MultiVectorCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = _MultiVectorCollection(
+                    self.data_dir / name
+                )
+            return self._collections[name]
+
+    async def upsert(
+        self,
+        collection_name: str,
+        points: list[models.PointStruct],
+        wait: bool = True,
+    ) -> None:
+        if points:
+            await asyncio.to_thread(
+                self._collection(collection_name).upsert, points
+            )
+
+    async def delete(
+        self,
+        collection_name: str,
+        points_selector: models.FilterSelector | models.Filter,
+        wait: bool = True,
+    ) -> None:
+        await asyncio.to_thread(
+            self._collection(collection_name).delete,
+            _selector_filter(points_selector),
+        )
+
+    async def set_payload(
+        self,
+        collection_name: str,
+        payload: dict[str, Any],
+        points: models.FilterSelector | models.Filter,
+        wait: bool = True,
+    ) -> None:
+        await asyncio.to_thread(
+            self._collection(collection_name).set_payload,
+            payload,
+            _selector_filter(points),
+        )
+
+    async def count(
+        self,
+        collection_name: str,
+        count_filter: models.Filter | None = None,
+        exact: bool = True,
+    ) -> models.CountResult:
+        count = await asyncio.to_thread(
+            self._collection(collection_name).count, count_filter
+        )
+        return models.CountResult(count=count)
+
+    async def query_points(
+        self,
+        collection_name: str,
+        query: list[list[float]],
+        limit: int = 10,
+        query_filter: models.Filter | None = None,
+        search_params: models.SearchParams | None = None,
+    ) -> QueryResponse:
+        # exact=True asks for the full MaxSim scan, like it does in Qdrant
+        exact = search_params is not None and bool(search_params.exact)
+        points = await asyncio.to_thread(
+            self._collection(collection_name).query,
+            np.asarray(query, dtype=np.float32),
+            limit,
+            query_filter,
+            0 if exact else self.prefilter,
+        )
+        return QueryResponse(points=points)
+
+    async def close(self) -> None:
+        with self._lock:
+            for collection in self._collections.values():
+                collection.close()
+            self._collections.clear()
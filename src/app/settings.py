@@ -22,6 +22,63 @@ class SupabaseSettings(BaseSettings):
 
 class AnthropicSettings(BaseSettings):
     api_key: str = os.environ.get("ANTHROPIC_API_KEY", "")
+    model: str = "claude-3-7-sonnet-latest"
+
+
+class IngestSettings(BaseSettings):
+    spool_dir: str = os.environ.get("INGEST_SPOOL_DIR", "")
+    upload_chunk_size: int = int(
+        os.environ.get("INGEST_UPLOAD_CHUNK_SIZE", "1048576")
+    )
+    render_window: int = int(os.environ.get("INGEST_RENDER_WINDOW", "8"))
+    dpi: int = 300
+
+
+class AdmissionSettings(BaseSettings):
+    ingest_max_concurrency: int = int(
+        os.environ.get("INGEST_MAX_CONCURRENCY", "2")
+    )
+    ingest_max_queue: int = int(os.environ.get("INGEST_MAX_QUEUE", "4"))
+    query_max_concurrency: int = int(
+        os.environ.get("QUERY_MAX_CONCURRENCY", "8")
+    )
+    query_max_queue: int = int(os.environ.get("QUERY_MAX_QUEUE", "32"))
+    queue_timeout: float = float(
+        os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30")
+    )
+    retry_after: int = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+    model_max_concurrency: int = int(
+        os.environ.get("MODEL_MAX_CONCURRENCY", "1")
+    )
+
+
+class AnswerCacheSettings(BaseSettings):
+    # Kept in process memory; only enable with a single uvicorn worker.
+    enabled: bool = os.environ.get("ANSWER_CACHE_ENABLED", "") == "true"
+    # Symmetric MaxSim of the ColQwen query embeddings above which a
+    # question with the same numbers and entities reuses a cached answer.
+    similarity_threshold: float = float(
+        os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")
+    )
+    max_entries: int = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+
+
+class StreamSettings(BaseSettings):
+    heartbeat_interval: float = float(
+        os.environ.get("STREAM_HEARTBEAT_INTERVAL", "15")
+    )
+
+
+class StorageSettings(BaseSettings):
+    mode: str = os.environ.get("STORAGE_MODE", "auto").lower()
+    multivector_dir: str = os.environ.get(
+        "LOCAL_MULTIVECTOR_DIR", "./data/multivector"
+    )
+    # Pages kept by the pooled-vector prefilter before exact MaxSim; 0 scores
+    # every page that passes the payload filter.
+    multivector_prefilter: int = int(
+        os.environ.get("LOCAL_MULTIVECTOR_PREFILTER", "0")
+    )
 
 
 class Settings(BaseSettings):
@@ -29,8 +86,21 @@ class Settings(BaseSettings):
     colpali: ColpaliSettings = ColpaliSettings()
     supabase: SupabaseSettings = SupabaseSettings()
     anthropic: AnthropicSettings = AnthropicSettings()
+    ingest: IngestSettings = IngestSettings()
+    admission: AdmissionSettings = AdmissionSettings()
+    answer_cache: AnswerCacheSettings = AnswerCacheSettings()
+    stream: StreamSettings = StreamSettings()
+    storage: StorageSettings = StorageSettings()
 
 
 @lru_cache
 def get_settings() -> Settings:
     return Settings()
+
+
+def use_local_storage(settings: Settings) -> bool:
+    # "auto" runs on the hosted backends only when both are configured:
+    # Qdrant for the page vectors and Supabase for the page images.
+    mode = settings.storage.mode
+    hosted = settings.qdrant.qdrant_url and settings.supabase.supabase_key
+    return mode == "local" or (mode == "auto" and not hosted)
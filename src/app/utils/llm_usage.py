@@ -0,0 +1,70 @@
+from functools import wraps
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from loguru import logger
+
+
+def log_usage(model: str | None, usage: dict[str, int | None]) -> None:
+    logger.info(
+        "LLM usage for {model}: input={input} output={output} "
+        "cache_read={cache_read} cache_write={cache_write}",
+        model=model,
+        input=usage.get("input_tokens"),
+        output=usage.get("output_tokens"),
+        cache_read=usage.get("cache_read_input_tokens"),
+        cache_write=usage.get("cache_creation_input_tokens"),
+    )
+
+
+def usage_to_dict(usage: Any) -> dict[str, int | None]:
+    return {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "cache_read_input_tokens": getattr(
+            usage, "cache_read_input_tokens", None
+        ),
+        "cache_creation_input_tokens": getattr(
+            usage, "cache_creation_input_tokens", None
+        ),
+    }
+
+
+class UsageRecordingStream:
+    def __init__(self, stream: Any, model: str | None) -> None:
+        self.stream = stream
+        self.model = model
+        self.usage: dict[str, int | None] = {}
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[Any]:
+        try:
+            async for event in self.stream:
+                event_type = getattr(event, "type", None)
+                if event_type == "message_start":
+                    self.usage.update(usage_to_dict(event.message.usage))
+                elif event_type == "message_delta":
+                    self.usage["output_tokens"] = event.usage.output_tokens
+                yield event
+        finally:
+            if self.usage:
+                log_usage(model=self.model, usage=self.usage)
+
+
+def record_usage(
+    create: Callable[..., Awaitable[Any]],
+) -> Callable[..., Awaitable[Any]]:
+    @wraps(create)
+    async def create_with_usage(*args: Any, **kwargs: Any) -> Any:
+        response = await create(*args, **kwargs)
+        if kwargs.get("stream"):
+            return UsageRecordingStream(
+                stream=response, model=kwargs.get("model")
+            )
+        log_usage(
+            model=kwargs.get("model"), usage=usage_to_dict(response.usage)
+        )
+        return response
+
+    return create_with_usage
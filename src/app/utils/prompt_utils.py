@@ -1,7 +1,69 @@
 from pathlib import Path
+from typing import Any
+
+from anthropic import AsyncAnthropic
+from anthropic.types import ToolParam
+from instructor import Partial, openai_schema
+
+from app.models.query_response import FinalResponse
+
+CACHE_CONTROL = {"type": "ephemeral"}
+# Anthropic ignores cache breakpoints on shorter prefixes (Sonnet models).
+MIN_CACHEABLE_TOKENS = 1024
 
 
 def read_prompt_from_plain_file(filename: str) -> str:
     filepath = Path(filename)
     with filepath.open(mode="r") as prompt:
         return prompt.read()
+
+
+def answer_tool() -> ToolParam:
+    # The tool instructor sends for create_partial(response_model=FinalResponse)
+    return openai_schema(Partial[FinalResponse]).anthropic_schema  # type: ignore[attr-defined]
+
+
+async def count_prefix_tokens(
+    client: AsyncAnthropic, model: str, system: str
+) -> int:
+    # Tools and system form the prefix in front of the first breakpoint;
+    # counted with the API's tokenizer, minus a one-message baseline.
+    tool = answer_tool()
+    probe = [{"role": "user", "content": "?"}]
+    with_prefix = await client.messages.count_tokens(
+        model=model,
+        system=system,
+        tools=[tool],
+        tool_choice={"type": "tool", "name": tool["name"]},
+        messages=probe,  # type: ignore[arg-type]
+    )
+    baseline = await client.messages.count_tokens(
+        model=model,
+        messages=probe,  # type: ignore[arg-type]
+    )
+    return with_prefix.input_tokens - baseline.input_tokens
+
+
+def build_query_messages(
+    prompts: dict[str, str],
+    filenames: list[str],
+    images: list[Any],
+    cache_prefix: bool = False,
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+    # The instructions never change between requests, so they go first as a
+    # system block; images and the query follow in the user turn. The block
+    # is marked for caching only when the prefix is long enough to be cached.
+    system: list[dict[str, Any]] = [
+        {"type": "text", "text": prompts["prompt1"]}
+    ]
+    if cache_prefix:
+        system[0]["cache_control"] = CACHE_CONTROL
+
+    query_content: list[str | object] = ["<images>"]
+    for filename, image in zip(filenames, images):
+        query_content.extend(
+            [f'\t<image file="{filename}">', image, "\t</image>"]
+        )
+    query_content.append(prompts["prompt2"])
+
+    return system, [{"role": "user", "content": query_content}]
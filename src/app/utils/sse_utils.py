@@ -0,0 +1,71 @@
+import asyncio
+import json
+from contextlib import suppress
+from typing import Any, AsyncIterator
+
+HEARTBEAT = ": heartbeat\n\n"
+
+
+def format_sse(event: str, data: str) -> str:
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event}\n{lines}\n"
+
+
+class ResponseDeltaEncoder:
+    def __init__(self) -> None:
+        self._answer_length = 0
+        self._references_sent = False
+        self._last: Any = None
+
+    def update(self, partial: Any) -> list[tuple[str, str]]:
+        self._last = partial
+        events = []
+        answer = partial.answer or ""
+        # References precede the answer in the response model, so they are
+        # complete once answer text starts arriving.
+        if answer and not self._references_sent:
+            events.extend(self._references(partial))
+        if len(answer) > self._answer_length:
+            delta = answer[self._answer_length :]
+            self._answer_length = len(answer)
+            events.append(("answer", json.dumps({"text": delta})))
+        return events
+
+    def finish(self) -> list[tuple[str, str]]:
+        if self._last is None or self._references_sent:
+            return []
+        return self._references(self._last)
+
+    def _references(self, partial: Any) -> list[tuple[str, str]]:
+        self._references_sent = True
+        references = [
+            reference.model_dump() for reference in partial.references or []
+        ]
+        return [("references", json.dumps({"references": references}))]
+
+
+async def with_heartbeats(
+    stream: AsyncIterator[str], interval: float
+) -> AsyncIterator[str]:
+    iterator = aiter(stream)
+    next_item = asyncio.ensure_future(anext(iterator))
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_item}, timeout=interval)
+            if not done:
+                yield HEARTBEAT
+                continue
+            try:
+                item = next_item.result()
+            except StopAsyncIteration:
+                return
+            yield item
+            next_item = asyncio.ensure_future(anext(iterator))
+    finally:
+        if not next_item.done():
+            next_item.cancel()
+            with suppress(asyncio.CancelledError, StopAsyncIteration):
+                await next_item
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,36 @@
+import hashlib
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+
+@dataclass(frozen=True)
+class SpooledUpload:
+    path: Path
+    sha256: str
+    size: int
+
+
+@asynccontextmanager
+async def spool_upload(
+    file: UploadFile, chunk_size: int, spool_dir: str | None = None
+) -> AsyncIterator[SpooledUpload]:
+    fd, name = tempfile.mkstemp(suffix=".pdf", dir=spool_dir or None)
+    path = Path(name)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while chunk := await file.read(chunk_size):
+                digest.update(chunk)
+                await run_in_threadpool(spool.write, chunk)
+                size += len(chunk)
+        yield SpooledUpload(path=path, sha256=digest.hexdigest(), size=size)
+    finally:
+        path.unlink(missing_ok=True)
@@ -0,0 +1,24 @@
+import sys
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def _app_modules() -> list[str]:
+    return [name for name in sys.modules if name.split(".")[0] == "app"]
+
+
+@pytest.fixture(scope="module")
+def local_app() -> Iterator[None]:
+    # The local tools' `app` package (repo root) shares its name with the
+    # API's (src/), so it is only importable inside tests that ask for it.
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name in _app_modules():
+            monkeypatch.delitem(sys.modules, name)
+        monkeypatch.syspath_prepend(str(ROOT))
+        yield
+        for name in _app_modules():
+            del sys.modules[name]
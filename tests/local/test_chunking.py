@@ -0,0 +1,45 @@
+def test_unbroken_text_is_split_to_the_chunk_size(local_app: None) -> None:
+    from app.chunking import chunk_text
+
+    chunks = list(chunk_text("x" * 2500, chunk_size=1000))
+
+    assert [len(chunk.text) for chunk in chunks] == [1000, 1000, 500]
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [
+        (0, 1000),
+        (1000, 2000),
+        (2000, 2500),
+    ]
+
+
+def test_no_chunk_exceeds_the_chunk_size(local_app: None) -> None:
+    from app.chunking import chunk_text
+
+    text = (
+        "A short sentence. "
+        + "https://example.com/"
+        + "a" * 700
+        + " then words without a full stop " * 40
+        + "\n\n"
+        + "b" * 950
+        + "."
+    )
+
+    chunks = list(chunk_text(text, chunk_size=300, overlap=50))
+
+    assert chunks
+    assert max(len(chunk.text) for chunk in chunks) <= 300
+    assert all(text[chunk.start : chunk.end] == chunk.text for chunk in chunks)
+
+
+def test_long_words_are_cut_by_the_size_measure(local_app: None) -> None:
+    from app.chunking import _units
+
+    # about three characters per unit, like a subword tokenizer
+    def measure(texts: list[str]) -> list[int]:
+        return [-(-len(text) // 3) for text in texts]
+
+    text = "y" * 100 + " z"
+    units = _units(text, 10, measure)
+
+    assert max(n for _, _, n in units) <= 10
+    assert "".join(text[s:e] for s, e, _ in units) == text
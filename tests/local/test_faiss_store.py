@@ -0,0 +1,102 @@
+import gc
+import weakref
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+
+DIM = 32
+# enough points to train 256 PQ centroids without faiss warnings
+N = 10_000
+
+
+# PQ training dominates the cost, so the tests share one collection.
+@pytest.fixture(scope="module")
+def pq_store(
+    local_app: None, tmp_path_factory: pytest.TempPathFactory
+) -> Iterator[tuple[Any, list[int], np.ndarray]]:
+    from app.storage import faiss_store
+    from app.storage.index_factory import index_kind, storage_kind
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(
+            faiss_store, "DATA_DIR", tmp_path_factory.mktemp("faiss_data")
+        )
+        store = faiss_store.LocalFaissStore()
+        store.create_collection(
+            "docs", dim=DIM, index_type="flat", storage="pq", rescore=False
+        )
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((N, DIM)).astype("float32")
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        ids = store.add_texts(
+            "docs",
+            [f"doc {i}" for i in range(N)],
+            [{"source": f"s{i % 2}"} for i in range(N)],
+            embeddings=vectors,
+        )
+        assert store.rebuild_index("docs") is not None
+        base = store._load_index("docs").base
+        assert (index_kind(base), storage_kind(base)) == ("flat", "pq")
+
+        yield store, ids, vectors
+        store.close()
+
+
+def test_flat_pq_search_skips_deleted_docs(pq_store: Any) -> None:
+    store, _, vectors = pq_store
+    query = vectors[:1]
+    # the nearest neighbours of the query, as the index ranks them
+    nearest = [id_ for _, id_ in store._dense_search("docs", query, 5)]
+
+    assert store.delete_by_ids("docs", nearest[:3]) == 3
+    hits = [id_ for _, id_ in store._dense_search("docs", query, 5)]
+
+    assert len(hits) == 5
+    assert not set(hits) & set(nearest[:3])
+    assert hits[:2] == nearest[3:]
+
+
+def test_flat_pq_search_applies_filter_selectors(
+    pq_store: Any, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from app.storage import faiss_store
+
+    store, ids, vectors = pq_store
+    # skip the exact scan so the filter reaches the index as a selector
+    monkeypatch.setattr(faiss_store, "FILTER_EXACT_LIMIT", 0)
+    odd = {id_ for i, id_ in enumerate(ids) if i % 2}
+
+    hits = store._dense_search("docs", vectors[1:2], 5, where={"source": "s1"})
+
+    assert len(hits) == 5
+    assert {id_ for _, id_ in hits} <= odd
+
+
+def test_evicted_collections_release_their_dbs(
+    local_app: None, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from app.storage import faiss_store
+
+    monkeypatch.setattr(faiss_store, "DATA_DIR", tmp_path)
+    # any index is over budget, so only the latest one stays open
+    store = faiss_store.LocalFaissStore(max_index_bytes=1)
+    vectors = np.eye(DIM, dtype="float32")[:4]
+    store.create_collection("a", dim=DIM)
+    store.add_texts("a", ["w", "x", "y", "z"], embeddings=vectors)
+    # held the way a search in flight holds it while "a" is evicted
+    in_flight = store._db("a")
+    released = {}
+    for name in ("b", "c"):
+        store.create_collection(name, dim=DIM)
+        store.add_texts(name, ["w", "x", "y", "z"], embeddings=vectors)
+        released[name] = weakref.ref(store._db(name))
+
+    assert list(store._dbs) == ["c"]
+    gc.collect()
+    assert released["b"]() is None
+    assert in_flight.meta()["dim"] == DIM
+    assert len(store._dense_search("a", vectors[:1], 2)) == 2
+    store.close()
@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from app.models.query_response import FinalResponse
+from app.services.answer_cache import (
+    AnswerCache,
+    prepare_query_embedding,
+    query_facts,
+)
+
+SESSION = "session"
+PAGES = frozenset({"session/report.pdf/3.jpeg"})
+QUESTION = "What was Acme's revenue in 2020?"
+ANSWER = FinalResponse(references=[], answer="It was $12M [1].")
+
+
+def embedding(seed: int, tokens: int = 24) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(tokens, 128, generator=generator)
+
+
+def paraphrase_of(base: torch.Tensor) -> torch.Tensor:
+    # close in meaning: every token moves only slightly
+    generator = torch.Generator().manual_seed(99)
+    noise = torch.randn(base.shape, generator=generator)
+    return base + 0.1 * noise
+
+
+@pytest.fixture
+def cache() -> AnswerCache:
+    cache = AnswerCache(similarity_threshold=0.95, max_entries=16)
+    cache.store(
+        session_id=SESSION,
+        pages=PAGES,
+        query=QUESTION,
+        embedding=prepare_query_embedding(embedding(0)),
+        response=ANSWER,
+        generation=0,
+    )
+    return cache
+
+
+def lookup(
+    cache: AnswerCache, query: str, query_embedding: torch.Tensor
+) -> FinalResponse | None:
+    return cache.lookup(
+        session_id=SESSION,
+        pages=PAGES,
+        query=query,
+        embedding=prepare_query_embedding(query_embedding),
+    )
+
+
+def test_paraphrase_reuses_the_cached_answer(cache: AnswerCache) -> None:
+    paraphrase = "How much revenue did Acme report in 2020?"
+
+    assert lookup(cache, paraphrase, paraphrase_of(embedding(0))) == ANSWER
+
+
+def test_same_question_hits_whatever_the_embedding(cache: AnswerCache) -> None:
+    assert lookup(cache, "what was acme's revenue in 2020", embedding(1))
+
+
+@pytest.mark.parametrize(
+    "near_miss",
+    [
+        "What was Acme's revenue in 2021?",
+        "What was Globex's revenue in 2020?",
+        "What was Acme's revenue in 2020 and 2021?",
+    ],
+)
+def test_near_miss_with_other_numbers_or_entities_is_rejected(
+    cache: AnswerCache, near_miss: str
+) -> None:
+    # even an identical embedding does not outweigh a changed fact
+    assert lookup(cache, near_miss, embedding(0)) is None
+
+
+def test_unrelated_question_is_rejected(cache: AnswerCache) -> None:
+    assert lookup(cache, "How did Acme do in 2020?", embedding(2)) is None
+
+
+def test_facts_ignore_sentence_case_and_possessives() -> None:
+    assert query_facts(QUESTION) == {"acme", "2020"}
+    assert query_facts("Revenue of ACME in 2,020 vs 2019?") == {
+        "acme",
+        "2020",
+        "2019",
+    }
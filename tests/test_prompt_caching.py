@@ -0,0 +1,187 @@
+import asyncio
+from pathlib import Path
+from typing import Any
+
+from anthropic.types import (
+    InputJSONDelta,
+    Message,
+    MessageTokensCount,
+    RawContentBlockDeltaEvent,
+    RawContentBlockStartEvent,
+    RawMessageStartEvent,
+    ToolUseBlock,
+    Usage,
+)
+from loguru import logger
+
+from app.api.state import create_instructor_client
+from app.models.query_response import FinalResponse
+from app.utils.prompt_utils import (
+    CACHE_CONTROL,
+    MIN_CACHEABLE_TOKENS,
+    build_query_messages,
+    count_prefix_tokens,
+    read_prompt_from_plain_file,
+)
+
+PROMPTS_DIR = Path(__file__).resolve().parent.parent / "prompts"
+
+
+def load_prompts() -> dict[str, str]:
+    return {
+        "prompt1": read_prompt_from_plain_file(str(PROMPTS_DIR / "response_1")),
+        "prompt2": read_prompt_from_plain_file(str(PROMPTS_DIR / "response_2")),
+    }
+
+
+class StubMessages:
+    def __init__(self, prefix_tokens: int = 0) -> None:
+        self.calls: list[dict[str, Any]] = []
+        self.count_calls: list[dict[str, Any]] = []
+        self.prefix_tokens = prefix_tokens
+
+    async def count_tokens(self, **kwargs: Any) -> MessageTokensCount:
+        self.count_calls.append(kwargs)
+        prefix = self.prefix_tokens if "system" in kwargs else 0
+        return MessageTokensCount(input_tokens=8 + prefix)
+
+    async def create(self, **kwargs: Any) -> Any:
+        self.calls.append(kwargs)
+        return self.events()
+
+    async def events(self) -> Any:
+        yield RawMessageStartEvent(
+            type="message_start",
+            message=Message(
+                id="msg_stub",
+                type="message",
+                role="assistant",
+                model="claude-3-7-sonnet-latest",
+                content=[],
+                stop_reason=None,
+                stop_sequence=None,
+                usage=Usage(
+                    input_tokens=12,
+                    output_tokens=1,
+                    cache_read_input_tokens=1500,
+                    cache_creation_input_tokens=0,
+                ),
+            ),
+        )
+        yield RawContentBlockStartEvent(
+            type="content_block_start",
+            index=0,
+            content_block=ToolUseBlock(
+                type="tool_use",
+                id="toolu_stub",
+                name="PartialFinalResponse",
+                input={},
+            ),
+        )
+        yield RawContentBlockDeltaEvent(
+            type="content_block_delta",
+            index=0,
+            delta=InputJSONDelta(
+                type="input_json_delta",
+                partial_json='{"references": [], "answer": "It is [1]."}',
+            ),
+        )
+
+
+class StubAnthropic:
+    def __init__(self, prefix_tokens: int = 0) -> None:
+        self.messages = StubMessages(prefix_tokens)
+
+
+def run_query(
+    query: str, cache_prefix: bool = True
+) -> tuple[dict[str, Any], list[Any]]:
+    stub = StubAnthropic()
+    client = create_instructor_client(anthropic_client=stub)  # type: ignore[arg-type]
+    system, messages = build_query_messages(
+        prompts=load_prompts(),
+        filenames=[],
+        images=[],
+        cache_prefix=cache_prefix,
+    )
+
+    async def collect() -> list[Any]:
+        stream = client.completions.create_partial(
+            model="claude-3-7-sonnet-latest",
+            response_model=FinalResponse,
+            system=system,
+            messages=messages,  # type: ignore
+            context={"query": query},
+            temperature=0.0,
+            max_tokens=8192,
+            max_retries=3,
+        )
+        return [partial async for partial in stream]
+
+    partials = asyncio.run(collect())
+    assert len(stub.messages.calls) == 1
+    return stub.messages.calls[0], partials
+
+
+def test_static_instructions_are_one_cached_system_block() -> None:
+    request, partials = run_query("What was the revenue in 2020?")
+
+    system = request["system"]
+    assert len(system) == 1
+    assert system[0]["cache_control"] == CACHE_CONTROL
+    assert system[0]["text"] == load_prompts()["prompt1"]
+    assert request["stream"] is True
+    assert partials[-1].answer == "It is [1]."
+
+
+def test_usage_log_reports_cache_reads() -> None:
+    lines: list[str] = []
+    sink = logger.add(lines.append, format="{message}")
+    try:
+        run_query("What was the revenue in 2020?")
+    finally:
+        logger.remove(sink)
+    assert any("cache_read=1500" in line for line in lines)
+
+
+def test_short_prefix_is_not_marked_for_caching() -> None:
+    request, partials = run_query(
+        "What was the revenue in 2020?", cache_prefix=False
+    )
+
+    assert request["system"] == [
+        {"type": "text", "text": load_prompts()["prompt1"]}
+    ]
+    assert partials[-1].answer == "It is [1]."
+
+
+def test_prefix_count_covers_the_tool_and_system() -> None:
+    stub = StubAnthropic(prefix_tokens=MIN_CACHEABLE_TOKENS)
+    system = load_prompts()["prompt1"]
+
+    tokens = asyncio.run(
+        count_prefix_tokens(
+            client=stub,  # type: ignore[arg-type]
+            model="claude-3-7-sonnet-latest",
+            system=system,
+        )
+    )
+
+    assert tokens == MIN_CACHEABLE_TOKENS
+    with_prefix, baseline = stub.messages.count_calls
+    assert with_prefix["system"] == system
+    assert with_prefix["tools"][0]["name"] == "PartialFinalResponse"
+    assert "system" not in baseline and "tools" not in baseline
+
+
+def test_query_only_changes_the_user_turn() -> None:
+    first, _ = run_query("What was the revenue in 2020?")
+    second, _ = run_query("What was the revenue in 2021?")
+
+    assert first["system"] == second["system"]
+    assert first["tools"] == second["tools"]
+    assert first["messages"] != second["messages"]
+    assert "revenue in 2020" in str(first["messages"])
+    assert all(
+        "cache_control" not in str(message) for message in first["messages"]
+    )
@@ -0,0 +1,31 @@
+import pytest
+
+from app.settings import (
+    QdrantSettings,
+    Settings,
+    StorageSettings,
+    SupabaseSettings,
+    use_local_storage,
+)
+
+
+@pytest.mark.parametrize(
+    ("mode", "qdrant_url", "supabase_key", "local"),
+    [
+        ("local", "http://qdrant:6333", "key", True),
+        ("remote", "", "", False),
+        ("auto", "http://qdrant:6333", "key", False),
+        ("auto", "", "key", True),
+        ("auto", "http://qdrant:6333", "", True),
+    ],
+)
+def test_auto_storage_needs_both_hosted_backends(
+    mode: str, qdrant_url: str, supabase_key: str, local: bool
+) -> None:
+    settings = Settings(
+        storage=StorageSettings(mode=mode),
+        qdrant=QdrantSettings(qdrant_url=qdrant_url),
+        supabase=SupabaseSettings(supabase_key=supabase_key),
+    )
+
+    assert use_local_storage(settings) is local